@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+#Allele counts and minor allele frequencies straight from the trees of a tree sequence
+#The number of samples carrying a mutation is the number of samples below its node, which
+#the trees already track, so no genotypes are decoded
+
+import numpy as np
+
+#plink2 .acount layout, one line per variant in the .bim
+acount_header = "#CHROM\tID\tREF\tALT\tALT_CTS\tOBS_CT\n"
+
+
+#Alleles of each site (ancestral first, in order of appearance, as ts.variants() gives them)
+#and how many samples carry each one
+#Mutations are applied in order: a mutation moves the samples below its node from the
+#state above it (its parent's, or the ancestral state) to its derived state
+def site_allele_counts(ts):
+	n = ts.num_samples
+	for tree in ts.trees():
+		for site in tree.sites():
+			alleles = [site.ancestral_state]
+			counts = {site.ancestral_state: n}
+			state = {}
+			for mutation in site.mutations:
+				if mutation.parent == -1:
+					parent_state = site.ancestral_state
+				else:
+					parent_state = state[mutation.parent]
+				state[mutation.id] = mutation.derived_state
+				carried = tree.num_samples(mutation.node)
+				counts[parent_state] -= carried
+				if mutation.derived_state not in counts:
+					alleles.append(mutation.derived_state)
+					counts[mutation.derived_state] = 0
+				counts[mutation.derived_state] += carried
+			yield alleles, [counts[allele] for allele in alleles]
+
+
+#Minor allele frequency of every site; sites that are not biallelic get nan
+def site_mafs(ts):
+	n = ts.num_samples
+	mafs = np.full(ts.num_sites, np.nan)
+	for k, (alleles, counts) in enumerate(site_allele_counts(ts)):
+		if len(alleles) == 2:
+			p = counts[1] / n
+			mafs[k] = min(p, 1 - p)
+	return mafs
+
+
+#Drop every site with a minor allele frequency below min_maf (and any non-biallelic site,
+#which the writers skip anyway), so rare variants never reach the VCF or .bed
+def filter_sites(ts, min_maf):
+	mafs = site_mafs(ts)
+	rare = np.where(~(mafs >= min_maf))[0]
+	print("MAF FILTER REMOVED", len(rare), "OF", ts.num_sites, "SITES", flush = True)
+	return ts.delete_sites(rare)
+
+
+#Derived (A1) allele counts for the variants plink_io.write_plink puts in the .bim, same IDs
+def write_acount(ts, prefix, chrom):
+	snp_id = 0
+	with open(prefix + ".acount", "w") as out:
+		out.write(acount_header)
+		for alleles, counts in site_allele_counts(ts):
+			if len(alleles) != 2:
+				continue
+			snp_id += 1
+			out.write(str(chrom) + "\t" + str(snp_id) + "\t" + alleles[0] + "\t" + alleles[1] + "\t" +
+			str(counts[1]) + "\t" + str(sum(counts)) + "\n")
+	return snp_id
+
+
+#One flag per .acount line: does the variant's minor allele frequency reach min_maf
+def maf_mask(prefix, min_maf):
+	keep = []
+	with open(prefix + ".acount", "r") as file:
+		for line in file:
+			if line.startswith("#"):
+				continue
+			fields = line.split()
+			p = int(fields[4]) / int(fields[5])
+			keep.append(min(p, 1 - p) >= min_maf)
+	return keep
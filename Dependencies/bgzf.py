@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+#BGZF (blocked gzip, as written by bgzip) with a tabix .tbi index built in the same pass
+#A BGZF file is a series of gzip members of at most 64 KB of data each, so any line can be
+#reached from a "virtual offset": the compressed offset of its block << 16 | offset in the block.
+#The index maps genomic bins and 16 kb windows to virtual offsets, as tabix -p vcf does.
+
+import struct
+import sys
+import zlib
+
+#data per block, the same limit bgzip uses
+max_block = 0xff00
+
+#empty block that marks the end of a BGZF file
+eof_block = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def compress_block(data, level = 6):
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+	cdata = compressor.compress(data) + compressor.flush()
+	header = struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+	return header + cdata + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+
+#Smallest bin of the UCSC binning scheme that holds [beg, end), 0-based
+def reg2bin(beg, end):
+	end -= 1
+	if beg >> 14 == end >> 14:
+		return ((1 << 15) - 1) // 7 + (beg >> 14)
+	if beg >> 17 == end >> 17:
+		return ((1 << 12) - 1) // 7 + (beg >> 17)
+	if beg >> 20 == end >> 20:
+		return ((1 << 9) - 1) // 7 + (beg >> 20)
+	if beg >> 23 == end >> 23:
+		return ((1 << 6) - 1) // 7 + (beg >> 23)
+	if beg >> 26 == end >> 26:
+		return ((1 << 3) - 1) // 7 + (beg >> 26)
+	return 0
+
+
+#Add a record spanning [start, end) virtual offsets at [beg, end_pos) on chrom to the index
+#index is {'names': [chrom, ...], chrom: (bins, linear)}; chunks in a bin that touch are merged
+def index_record(index, chrom, beg, end_pos, start, end):
+	if chrom not in index:
+		index['names'].append(chrom)
+		index[chrom] = ({}, {})
+	bins, linear = index[chrom]
+	chunks = bins.setdefault(reg2bin(beg, end_pos), [])
+	if chunks and chunks[-1][1] == start:
+		chunks[-1][1] = end
+	else:
+		chunks.append([start, end])
+	for window in range(beg >> 14, ((end_pos - 1) >> 14) + 1):
+		if window not in linear:
+			linear[window] = start
+
+
+#Stream header and records into a BGZF file and write its tabix index next to it
+#records yields (line, chrom, pos, ref_length) with 1-based positions, sorted within each chromosome
+def write_indexed(path, header, records, level = 6):
+	index = {'names': []}
+	buf = bytearray()
+	coffset = 0
+	with open(path, "wb") as out:
+		def add(text):
+			nonlocal coffset
+			buf.extend(text.encode())
+			while len(buf) >= max_block:
+				block = compress_block(bytes(buf[:max_block]), level)
+				out.write(block)
+				coffset += len(block)
+				del buf[:max_block]
+
+		add(header)
+		n_records = 0
+		for line, chrom, pos, ref_length in records:
+			start = coffset << 16 | len(buf)
+			add(line)
+			index_record(index, str(chrom), pos - 1, pos - 1 + ref_length, start, coffset << 16 | len(buf))
+			n_records += 1
+		if buf:
+			out.write(compress_block(bytes(buf), level))
+		out.write(eof_block)
+	write_tbi(path + ".tbi", index)
+	return n_records
+
+
+#Uncompressed blocks of a BGZF file with the compressed offsets of the block and the one after it
+def read_blocks(path):
+	with open(path, "rb") as file:
+		coffset = 0
+		while True:
+			header = file.read(18)
+			if len(header) < 18:
+				return
+			bsize = struct.unpack("<H", header[16:18])[0]
+			rest = file.read(bsize - 17)
+			yield coffset, coffset + bsize + 1, zlib.decompress(rest[:-8], -15)
+			coffset += bsize + 1
+
+
+#Index an existing BGZF-compressed VCF (e.g. one written by plink --recode vcf bgz), reading it once
+def index_vcf(path):
+	index = {'names': []}
+	partial = b""
+	start = None
+	for coffset, next_coffset, data in read_blocks(path):
+		pos = 0
+		while pos < len(data):
+			if start is None:
+				start = coffset << 16 | pos
+			newline = data.find(b"\n", pos)
+			if newline < 0:
+				partial += data[pos:]
+				break
+			line = partial + data[pos:newline]
+			partial = b""
+			pos = newline + 1
+			#as in write_indexed, a line that fills a block ends at the start of the next one
+			end = next_coffset << 16 if pos == len(data) == max_block else coffset << 16 | pos
+			if not line.startswith(b"#"):
+				fields = line.split(b"\t", 4)
+				beg = int(fields[1]) - 1
+				index_record(index, fields[0].decode(), beg, beg + len(fields[3]), start, end)
+			start = None
+	write_tbi(path + ".tbi", index)
+
+
+#Tabix index in the .tbi layout: VCF preset (sequence in column 1, position in column 2, '#' comments)
+def write_tbi(path, index):
+	names = b"".join(name.encode() + b"\0" for name in index['names'])
+	parts = [b"TBI\1", struct.pack("<8i", len(index['names']), 2, 1, 2, 0, ord('#'), 0, len(names)), names]
+	for name in index['names']:
+		bins, linear = index[name]
+		parts.append(struct.pack("<i", len(bins)))
+		for bin_id in sorted(bins):
+			parts.append(struct.pack("<Ii", bin_id, len(bins[bin_id])))
+			for start, end in bins[bin_id]:
+				parts.append(struct.pack("<QQ", start, end))
+		#windows without a record of their own point at the previous window's offset
+		n_windows = max(linear) + 1 if linear else 0
+		offsets = []
+		for window in range(n_windows):
+			offsets.append(linear.get(window, offsets[-1] if offsets else 0))
+		parts.append(struct.pack("<i", n_windows))
+		parts.append(struct.pack("<" + str(n_windows) + "Q", *offsets))
+	data = b"".join(parts)
+	with open(path, "wb") as out:
+		for start in range(0, len(data), max_block):
+			out.write(compress_block(data[start:start + max_block]))
+		out.write(eof_block)
+
+
+if __name__ == '__main__':
+	if len(sys.argv) != 2:
+		sys.exit("usage: bgzf.py file.vcf.gz    (writes file.vcf.gz.tbi)")
+	index_vcf(sys.argv[1])
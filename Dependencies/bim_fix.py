@@ -1,42 +1,26 @@
 #!/usr/bin/env python3
 
-import fileinput
-from pandas_plink import read_plink
-import pandas as pd
-from pyplink import PyPlink
-import sys
-
-
-infile = sys.argv[1]
-outfile = sys.argv[2]
-chrom = sys.argv[3]
-
-(bim, fam, bed) = read_plink(
-	infile, 
-	verbose = True
-	)
+#Renumber the SNP IDs of a .bim from 1 and set its chromosome column
+#The file is streamed line by line, so memory use does not grow with the number of variants,
+#and only the ID, chromosome and (zero) centimorgan columns are touched
 
-bim['snp'] = range(1, 1+len(bim))
-#bim['pos'] = 0
-bim['chrom'] = chrom
-
-bim.drop(
-	"i", 
-	axis=1, 
-	inplace=True
-	)
-
-filedata = bim.to_string(
-	header=False, 
-	index=False
-	)
-print("SNP IDs IN PLACE")
-
-filedata = filedata.replace("0.0","0")
+import sys
 
 
-with open(outfile,"w") as file:
-	file.write(filedata)
+def fix_bim(infile, outfile, chrom):
+	with open(infile + ".bim", "r") as bim, open(outfile, "w") as out:
+		for snp_id, line in enumerate(bim, 1):
+			fields = line.split()
+			fields[0] = str(chrom)
+			fields[1] = str(snp_id)
+			#plink writes the centimorgan column as 0.0 or 0; keep it as 0 like the rest of the pipeline
+			if float(fields[2]) == 0:
+				fields[2] = "0"
+			out.write("\t".join(fields) + "\n")
+	print("SNP IDs IN PLACE")
 
 
-exit()
+if __name__ == '__main__':
+	if len(sys.argv) != 4:
+		sys.exit("usage: bim_fix.py bfile_prefix out.bim chrom")
+	fix_bim(sys.argv[1], sys.argv[2], sys.argv[3])
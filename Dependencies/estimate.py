@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+#Pre-flight estimates for a run: checks the demography with msprime's demography debugger and
+#extrapolates tree sequence size, output file sizes, wall time and peak memory from short
+#calibration simulations, so a run that would take days or run out of memory is caught before it starts
+
+import math
+import warnings
+
+import numpy as np
+
+#Calibration regions start at this fraction of the chromosome and double until a run takes
+#long enough to time reliably (or the region would pass max_fraction); the last three are used
+first_fraction = 0.005
+max_fraction = 0.5
+min_calibration_time = 5.0
+
+
+#Epochs, size trajectories and pairwise coalescence of the demography, with warnings for the
+#things that make a simulation hang or blow up: pairs of lineages that may never coalesce, and
+#populations shrinking below one individual or growing without bound while lineages remain
+#msprime's own warnings (e.g. misspecified migration) are passed on as well
+def demography_report(demography, history_path):
+	with warnings.catch_warnings(record = True) as caught:
+		warnings.simplefilter("always")
+		debugger = demography.debug()
+		with open(history_path, "w") as file:
+			debugger.print_history(output = file)
+
+		last_event = max([event.time for event in demography.events] + [1])
+		steps = np.concatenate([[0], np.geomspace(1, 100 * last_event, 2000)])
+		sizes = debugger.population_size_trajectory(steps)
+
+		#a pair of lineages from each population and from each pair of populations
+		coalescence = {}
+		horizon = 0
+		problems = []
+		n_pops = len(demography.populations)
+		for i in range(n_pops):
+			for j in range(i, n_pops):
+				lineages = {i: 2} if i == j else {i: 1, j: 1}
+				name = demography.populations[i].name + "," + demography.populations[j].name
+				_, uncoalesced = debugger.coalescence_rate_trajectory(steps, lineages)
+				coalescence[name] = {'uncoalesced_at_end': float(uncoalesced[-1])}
+				if uncoalesced[-1] > 0.001:
+					problems.append("a pair of lineages from " + name + " has not coalesced after " + 
+					str(int(steps[-1])) + " generations (P = " + str(round(float(uncoalesced[-1]), 3)) + ")")
+					horizon = len(steps)
+				else:
+					coalescence[name]['mean_coalescence_time'] = float(debugger.mean_coalescence_time(lineages))
+					horizon = max(horizon, int(np.argmax(uncoalesced <= 0.001)) + 1)
+
+	#sizes only matter while there are lineages left to coalesce
+	for k, population in enumerate(demography.populations):
+		active = sizes[:horizon, k]
+		if not np.all(np.isfinite(active)) or np.max(active) > 1e10:
+			problems.append(population.name + " grows above 1e10 individuals")
+		if np.min(active) < 1:
+			problems.append(population.name + " shrinks below one individual at generation " +
+			str(int(steps[np.argmax(active < 1)])))
+
+	for warning in caught:
+		message = str(warning.message)
+		if "number of steps" not in message and message not in problems:
+			problems.append(message)
+
+	return {
+		'epochs': len(debugger.epochs),
+		'last_event_generation': float(last_event),
+		'coalescence': coalescence,
+		'size_trajectory': {
+			'generations': steps.tolist(),
+			'sizes': {population.name: sizes[:, k].tolist() for k, population in enumerate(demography.populations)}
+			},
+		'warnings': problems
+		}
+
+
+#Counts, file sizes and memory grow linearly with the region, on top of a fixed overhead
+def extrapolate_linear(lengths, values, length):
+	slope, intercept = np.polyfit(lengths, values, 1)
+	return max(slope, 0) * length + max(intercept, 0)
+
+
+#Simulation time grows faster than linearly, close to quadratically for long regions, and the
+#exponent creeps up with length: time = a * length^b through the two longest runs, 1 <= b <= 2
+def extrapolate_power(lengths, values, length):
+	b = math.log(max(values[-1], 1e-6) / max(values[-2], 1e-6)) / math.log(lengths[-1] / lengths[-2])
+	b = min(max(b, 1.0), 2.0)
+	return values[-1] * (length / lengths[-1]) ** b
+
+
+#Sizes in bytes of the files written for a fileset of n_sites variants and n_ind individuals
+def output_sizes(n_sites, n_ind, chrom, length):
+	id_digits = len(str(max(int(n_sites), 1)))
+	pos_digits = len(str(int(length)))
+	bim_line = len(str(chrom)) + id_digits + pos_digits + 9
+	vcf_line = len(str(chrom)) + pos_digits + id_digits + 22 + 4 * n_ind
+	return {
+		'bed': int(3 + n_sites * ((n_ind + 3) // 4)),
+		'bim': int(n_sites * bim_line),
+		'fam': int(n_ind * (2 * len("msp_" + str(n_ind)) + 10)),
+		'vcf': int(n_sites * vcf_line)
+		}
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+#Admixture diagnostics computed on the tree sequence itself, in seconds rather than the
+#hours ADMIXTURE takes: f2, f3, f4, Patterson's D and Fst between PAR1, PAR2 and ADM,
+#in branch mode (expected values given the trees) and site mode (the mutations we got)
+#
+#The model has no outgroup population, so f4 and D use the ancestral allele as the outgroup
+#(a sample set fixed for the ancestral state at every site)
+#f4(PAR1,PAR2;ADM,ANC) follows ADMIXTOOLS, (p1 - p2)(p3 - p0) = BABA - ABBA with p0 = 0, so it is positive
+#when ADM shares more derived alleles with PAR1; D is Patterson's (ABBA - BABA) / (ABBA + BABA), which
+#has the opposite sign (qpDstat's D has f4's sign)
+
+import json
+import sys
+
+import numpy as np
+import tskit
+
+pop_names = ['PAR1', 'PAR2', 'ADM'] #population IDs 0, 1 and 2 in the models
+
+
+#PAR1, PAR2, ADM: ABBA and BABA site patterns against the ancestral state,
+#from derived allele frequencies
+def abba_baba(x, n):
+	p = x / n
+	abba = (1 - p[0]) * p[1] * p[2]
+	baba = p[0] * (1 - p[1]) * p[2]
+	return np.array([abba, baba])
+
+
+#Admixture proportion from PAR1 in ADM, from ADM = a*PAR1 + (1 - a)*PAR2 plus drift:
+#f2(ADM, PAR2) - f2(ADM, PAR1) = (2a - 1) f2(PAR1, PAR2), the drift in ADM cancels out
+def alpha_from_f2(f2_12, f2_13, f2_23):
+	return (1 + (f2_23 - f2_13) / f2_12) / 2
+
+
+def admixture_stats(ts, mode = 'site'):
+	sets = [ts.samples(population = k) for k in range(3)]
+	n = np.array([len(s) for s in sets])
+
+	f2_12, f2_13, f2_23 = ts.f2(sets, indexes = [(0, 1), (0, 2), (1, 2)], mode = mode)
+	f3 = ts.f3(sets, indexes = [(2, 0, 1)], mode = mode)[0]
+	fst_12, fst_13, fst_23 = ts.Fst(sets, indexes = [(0, 1), (0, 2), (1, 2)], mode = mode)
+	abba, baba = ts.sample_count_stat(sets, lambda x: abba_baba(x, n), 2, mode = mode, polarised = True)
+
+	return {
+		'f2(PAR1,PAR2)': float(f2_12),
+		'f2(PAR1,ADM)': float(f2_13),
+		'f2(PAR2,ADM)': float(f2_23),
+		'f3(ADM;PAR1,PAR2)': float(f3),
+		'f4(PAR1,PAR2;ADM,ANC)': float(baba - abba),
+		'D(PAR1,PAR2;ADM,ANC)': float((abba - baba) / (abba + baba)) if abba + baba > 0 else float('nan'),
+		'Fst(PAR1,PAR2)': float(fst_12),
+		'Fst(PAR1,ADM)': float(fst_13),
+		'Fst(PAR2,ADM)': float(fst_23),
+		'alpha_pop1': float(alpha_from_f2(f2_12, f2_13, f2_23))
+		}
+
+
+#Both modes, written as JSON
+def write_diagnostics(ts, path):
+	results = {mode: admixture_stats(ts, mode) for mode in ('branch', 'site')}
+	with open(path, "w") as file:
+		json.dump(results, file, indent = 1, sort_keys = True)
+	return results
+
+
+if __name__ == '__main__':
+	if len(sys.argv) != 3:
+		sys.exit("usage: fstats.py trees_file out.json")
+	write_diagnostics(tskit.load(sys.argv[1]), sys.argv[2])
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+#The genotype matrix of a tree sequence as memory-mappable .npy files or a chunked Zarr group,
+#for NumPy analyses that should not have to parse the VCF or .bed again
+#
+#Rows are the variants of the .bim written from the same trees, in the same order; columns are
+#haplotypes (sample nodes), each consecutive pair being one diploid individual; 0 is the ancestral
+#allele (A2) and 1 the derived one (A1). Packed matrices hold 8 haplotypes per byte, np.packbits order.
+#Next to the matrix: chromosomes and positions (from the .bim, so merged runs keep each chromosome's
+#own coordinates), alleles (ancestral, derived), sample IDs and the population of each individual
+#
+#	geno = np.load("genotypes_21.npy", mmap_mode = 'r')      (nothing is read until it is indexed)
+#	haps = np.unpackbits(packed[rows], axis = 1, count = 2 * len(samples))
+
+import sys
+
+import numpy as np
+
+from plink_io import sample_names
+from fstats import pop_names
+
+#sites decoded and written at a time, and rows per Zarr chunk
+block_size = 10000
+
+#haplotypes per Zarr chunk (columns are bytes of 8 haplotypes when packed)
+chunk_haplotypes = 4096
+
+
+#Chromosome and position of every variant in the .bim
+def read_bim_sites(prefix):
+	chroms = []
+	positions = []
+	with open(prefix + ".bim", "r") as bim:
+		for line in bim:
+			fields = line.split()
+			chroms.append(fields[0])
+			positions.append(int(fields[3]))
+	return np.array(chroms), np.array(positions, dtype = np.int64)
+
+
+#Stream the biallelic sites of ts.variants() (the ones the .bim holds) into target, a memory-mapped
+#array or a Zarr array, block_size rows at a time; returns the alleles of the rows written
+def write_rows(ts, target, packed):
+	block = np.zeros((block_size, ts.num_samples), dtype = np.int8)
+	alleles = []
+	k = 0
+	row = 0
+	for variant in ts.variants():
+		if len(variant.alleles) != 2:
+			continue
+		if row + k == target.shape[0]:
+			raise ValueError("the tree sequence has more biallelic sites than the .bim")
+		block[k] = variant.genotypes
+		alleles.append(variant.alleles)
+		k += 1
+		if k == block_size:
+			target[row:row + k] = np.packbits(block, axis = 1) if packed else block
+			row += k
+			k = 0
+	if k > 0:
+		target[row:row + k] = np.packbits(block[:k], axis = 1) if packed else block[:k]
+	if row + k != target.shape[0]:
+		raise ValueError("the tree sequence has fewer biallelic sites than the .bim")
+	return np.array(alleles, dtype = str).reshape(-1, 2)
+
+
+def sample_metadata(ts):
+	n_ind = ts.num_samples // 2
+	populations = ts.tables.nodes.population[ts.samples()[0::2]]
+	return np.array(sample_names(n_ind)), np.array(pop_names)[populations]
+
+
+def matrix_shape(ts, n_sites, packed):
+	return (n_sites, (ts.num_samples + 7) // 8 if packed else ts.num_samples)
+
+
+#prefix.npy plus prefix_chroms.npy, prefix_positions.npy, prefix_alleles.npy, prefix_samples.npy and
+#prefix_populations.npy, for the fileset bim_prefix.bim written from ts
+#The matrix is written through a memory map, so only one block of it is ever in memory
+def write_npy(ts, bim_prefix, prefix, packed = False):
+	chroms, positions = read_bim_sites(bim_prefix)
+	geno = np.lib.format.open_memmap(prefix + ".npy", mode = "w+",
+		dtype = np.uint8 if packed else np.int8, shape = matrix_shape(ts, len(positions), packed))
+	alleles = write_rows(ts, geno, packed)
+	geno.flush()
+	del geno
+	samples, populations = sample_metadata(ts)
+	np.save(prefix + "_chroms.npy", chroms)
+	np.save(prefix + "_positions.npy", positions)
+	np.save(prefix + "_alleles.npy", alleles)
+	np.save(prefix + "_samples.npy", samples)
+	np.save(prefix + "_populations.npy", populations)
+	return len(positions)
+
+
+#A Zarr group at path with the arrays genotypes, chroms, positions, alleles, samples and populations
+#zarr is only needed for this format, so it is imported here
+def write_zarr(ts, bim_prefix, path, packed = False):
+	import zarr
+	chroms, positions = read_bim_sites(bim_prefix)
+	group = zarr.open_group(path, mode = "w")
+	#create_array in zarr 3, create_dataset in zarr 2
+	create = getattr(group, "create_array", None) or group.create_dataset
+	geno = create("genotypes", shape = matrix_shape(ts, len(positions), packed), dtype = np.uint8 if packed else np.int8,
+		chunks = (block_size, chunk_haplotypes // 8 if packed else chunk_haplotypes))
+	alleles = write_rows(ts, geno, packed)
+	samples, populations = sample_metadata(ts)
+	for name, values in (('chroms', chroms), ('positions', positions), ('alleles', alleles), ('samples', samples), ('populations', populations)):
+		array = create(name, shape = values.shape, dtype = values.dtype, chunks = values.shape)
+		array[...] = values
+	group.attrs['packed'] = packed
+	group.attrs['n_haplotypes'] = ts.num_samples
+	return len(positions)
+
+
+if __name__ == '__main__':
+	if len(sys.argv) != 4 or sys.argv[3] not in ('npy', 'packed', 'zarr', 'zarr-packed'):
+		sys.exit("usage: geno_export.py model_prefix out_prefix npy|packed|zarr|zarr-packed    (reads model_prefix.trees and .bim)")
+	import tskit
+	ts = tskit.load(sys.argv[1] + ".trees")
+	if sys.argv[3].startswith('zarr'):
+		write_zarr(ts, sys.argv[1], sys.argv[2] + ".zarr", sys.argv[3] == 'zarr-packed')
+	else:
+		write_npy(ts, sys.argv[1], sys.argv[2], sys.argv[3] == 'packed')
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+#Windowed r^2 pruning following the rules of plink --indep-pairwise <window> <step> <r2>
+#These rules are reimplemented from plink's documentation and behaviour. They have not been checked
+#against plink's own prune.in lists, so run --prune-engine plink when the lists must match plink's
+#Windows of `window` variants slide by `step` within each chromosome. Whenever two
+#remaining variants in a window have genotypic r^2 above the threshold, the one with the
+#lower minor allele frequency is pruned (the later one on ties), scanning pairs in order.
+#
+#After a window has been scanned no pair of remaining variants in it is in LD, so only
+#pairs involving the variants that enter with each step can prune anything. All such
+#pairs above the threshold are found up front with blocked matrix products, leaving a
+#short sequential pass over the (few) conflicting pairs to decide which variant goes.
+
+import sys
+
+import numpy as np
+
+import plink_io
+
+#plink's tolerance when comparing allele frequencies
+maf_epsilon = 2.0 ** -44
+
+#genotypes per block read from the .bed (variants x individuals) unless a block_size is given;
+#each float64 matrix of a block stays around 32 MB whatever the number of individuals
+block_elements = 1 << 22
+
+
+def read_bim_ids(prefix):
+	chroms = []
+	snp_ids = []
+	with open(prefix + ".bim", "r") as bim:
+		for line in bim:
+			fields = line.split()
+			chroms.append(fields[0])
+			snp_ids.append(fields[1])
+	return chroms, snp_ids
+
+
+#Rows scaled to mean 0 and variance 1, so r = mean(z_i * z_j); monomorphic rows become 0
+def standardize(dosage):
+	g = dosage.astype(np.float64)
+	missing = dosage < 0
+	g[missing] = np.nan
+	mean = np.nanmean(g, axis = 1)
+	sd = np.nanstd(g, axis = 1)
+	z = (g - mean[:, None]) / np.where(sd > 0, sd, 1)[:, None]
+	z[missing] = 0
+	z[sd == 0] = 0
+	p = mean / 2
+	return z, np.minimum(p, 1 - p)
+
+
+#Pairs (i, j), i < j < i + window, with r^2 above the threshold, plus every variant's MAF
+#Blocks from the .bed are carried over by window - 1 rows so pairs spanning blocks are found
+def ld_pairs(prefix, window, threshold, block_size = None, chunk = 64):
+	if block_size is None:
+		block_size = plink_io.block_rows(prefix, block_elements)
+	first = []
+	second = []
+	mafs = []
+	carry = None
+	offset = 0
+
+	def scan(buf, n_rows, offset):
+		n_ind = buf.shape[1]
+		for a in range(0, n_rows, chunk):
+			b = min(a + chunk, n_rows)
+			hi = min(b + window - 1, len(buf))
+			r2 = (buf[a:b] @ buf[a:hi].T / n_ind) ** 2
+			lag = np.arange(a, hi)[None, :] - np.arange(a, b)[:, None]
+			rows, cols = np.nonzero((lag > 0) & (lag < window) & (r2 > threshold))
+			first.append(offset + a + rows)
+			second.append(offset + a + cols)
+
+	for dosage in plink_io.read_bed(prefix, block_size):
+		z, maf = standardize(dosage)
+		mafs.append(maf)
+		buf = z if carry is None else np.vstack([carry, z])
+		n_ready = len(buf) - (window - 1)
+		if n_ready > 0:
+			scan(buf, n_ready, offset)
+			carry = buf[n_ready:]
+			offset += n_ready
+		else:
+			carry = buf
+	if carry is not None and len(carry) > 0:
+		scan(carry, len(carry), offset)
+
+	if not mafs:
+		return np.zeros(0, dtype = int), np.zeros(0, dtype = int), np.zeros(0)
+	return np.concatenate(first), np.concatenate(second), np.concatenate(mafs)
+
+
+#Boolean mask of the variants kept (prune.in) by these rules
+def prune(prefix, window = 50, step = 2, threshold = 0.8, block_size = None):
+	chroms, _ = read_bim_ids(prefix)
+	n_snps = len(chroms)
+	removed = np.zeros(n_snps, dtype = bool)
+	if n_snps == 0:
+		return ~removed
+
+	#index of the first variant of each variant's chromosome
+	chrom_start = np.zeros(n_snps, dtype = int)
+	for k in range(1, n_snps):
+		chrom_start[k] = chrom_start[k - 1] if chroms[k] == chroms[k - 1] else k
+
+	first, second, maf = ld_pairs(prefix, window, threshold, block_size)
+	same_chrom = chrom_start[first] == chrom_start[second]
+	first, second = first[same_chrom], second[same_chrom]
+
+	#window in which the later variant of each pair first appears, and where that window starts
+	c0 = chrom_start[second]
+	entry = np.maximum(0, (second - c0 - window) // step + 1)
+	start = c0 + entry * step
+	in_window = first >= start
+	first, second, entry, c0 = first[in_window], second[in_window], entry[in_window], c0[in_window]
+
+	#pairs are decided in the order plink scans them: by window, then first, then second variant
+	for k in np.lexsort((second, first, entry, c0)):
+		i, j = first[k], second[k]
+		if removed[i] or removed[j]:
+			continue
+		if maf[i] < (1 - maf_epsilon) * maf[j]:
+			removed[i] = True
+		else:
+			removed[j] = True
+	return ~removed
+
+
+#Writes out_prefix.prune.in and out_prefix.prune.out in the layout of plink --indep-pairwise --out out_prefix
+def write_prune_lists(prefix, out_prefix, window = 50, step = 2, threshold = 0.8):
+	keep = prune(prefix, window, step, threshold)
+	_, snp_ids = read_bim_ids(prefix)
+	with open(out_prefix + ".prune.in", "w") as keep_file, open(out_prefix + ".prune.out", "w") as drop_file:
+		for snp, kept in zip(snp_ids, keep):
+			(keep_file if kept else drop_file).write(snp + "\n")
+	return keep
+
+
+if __name__ == '__main__':
+	if len(sys.argv) != 6:
+		sys.exit("usage: ld_prune.py bfile_prefix out_prefix window step r2")
+	write_prune_lists(sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), float(sys.argv[5]))
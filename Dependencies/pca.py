@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+#In-process PCA of a plink fileset, written out in plink --pca layout
+#Genotypes are read from the .bed in blocks and never held in memory all at once:
+#a randomized SVD only needs products of the standardized genotype matrix with a
+#thin (individuals x (PCs + oversampling)) matrix, which are accumulated block by block
+
+import sys
+
+import numpy as np
+
+import plink_io
+
+#genotypes per block (variants x individuals) unless a block_size is given; each float64 matrix
+#of a block stays around 32 MB whatever the number of individuals
+block_elements = 1 << 22
+
+
+#Each variant scaled by its allele frequency as in plink's relationship matrix,
+#(dosage - 2p) / sqrt(2p(1 - p)); monomorphic variants are dropped and missing calls set to 0
+def standardized_blocks(prefix, block_size):
+	for dosage in plink_io.read_bed(prefix, block_size):
+		missing = dosage < 0
+		g = dosage.astype(np.float64)
+		g[missing] = 0
+		called = (~missing).sum(axis = 1)
+		p = g.sum(axis = 1) / np.maximum(2 * called, 1)
+		keep = (p > 0) & (p < 1)
+		x = (g[keep] - 2 * p[keep, None]) / np.sqrt(2 * p[keep] * (1 - p[keep]))[:, None]
+		x[missing[keep]] = 0
+		yield x
+
+
+#Top n_pcs eigenvalues and eigenvectors of X'X / M, where X is the standardized M x N genotype matrix
+#n_iter power iterations sharpen the subspace; each one is a pass over the .bed
+def randomized_pca(prefix, n_pcs = 20, block_size = None, oversample = 10, n_iter = 3, seed = 1):
+	n_ind = plink_io.count_lines(prefix + ".fam")
+	if block_size is None:
+		block_size = plink_io.block_rows(prefix, block_elements)
+	n_pcs = min(n_pcs, n_ind)
+	width = min(n_pcs + oversample, n_ind)
+	rng = np.random.default_rng(seed)
+
+	basis = rng.standard_normal((n_ind, width))
+	for _ in range(n_iter + 1):
+		projected = np.zeros((n_ind, width))
+		for x in standardized_blocks(prefix, block_size):
+			projected += x.T @ (x @ basis)
+		basis, _ = np.linalg.qr(projected)
+
+	#Rayleigh-Ritz step on the captured subspace
+	small = np.zeros((width, width))
+	n_snps = 0
+	for x in standardized_blocks(prefix, block_size):
+		z = x @ basis
+		small += z.T @ z
+		n_snps += x.shape[0]
+	if n_snps == 0:
+		raise ValueError("No polymorphic variants in " + prefix + ".bed")
+
+	evals, evecs = np.linalg.eigh(small)
+	order = np.argsort(evals)[::-1][:n_pcs]
+	return evals[order] / n_snps, basis @ evecs[:, order]
+
+
+#Same files as plink --pca --out out_prefix, so pca_plot.R can read them unchanged
+def write_pca(prefix, out_prefix, n_pcs = 20, block_size = None):
+	eigenvalues, eigenvectors = randomized_pca(prefix, n_pcs = n_pcs, block_size = block_size)
+
+	with open(prefix + ".fam", "r") as fam, open(out_prefix + ".eigenvec", "w") as out:
+		for line, row in zip(fam, eigenvectors):
+			fid, iid = line.split()[:2]
+			out.write(fid + " " + iid + " " + " ".join("%.6g" % v for v in row) + "\n")
+
+	with open(out_prefix + ".eigenval", "w") as out:
+		for value in eigenvalues:
+			out.write("%.6g\n" % value)
+
+
+if __name__ == '__main__':
+	if len(sys.argv) != 3:
+		sys.exit("usage: pca.py bfile_prefix out_prefix")
+	write_pca(sys.argv[1], sys.argv[2])
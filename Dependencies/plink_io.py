@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+#Writes plink .bed/.bim/.fam filesets straight from an msprime tree sequence
+#Replaces the old VCF -> plink --vcf -> fam_fix.pl -> bim_fix.py round trip
+
+import numpy as np
+
+bed_magic = bytes([0x6c, 0x1b, 0x01]) #SNP-major .bed header
+
+#2-bit .bed codes indexed by the number of copies of A1 (the derived allele)
+#0 copies = 11 (homozygous A2), 1 copy = 10 (het), 2 copies = 00 (homozygous A1)
+bed_codes = np.array([3, 2, 0], dtype = np.uint8)
+
+
+#Sample IDs used everywhere downstream, matching population_information.txt
+#(msp_0 becomes msp_00 because plink treats an ID of 0 as missing)
+def sample_names(n_ind):
+	names = ["msp_" + str(i) for i in range(n_ind)]
+	if n_ind > 0:
+		names[0] = "msp_00"
+	return names
+
+
+#Integer VCF/.bim coordinates for each site
+#Positions are rounded and bumped where needed so they are strictly increasing and >= 1
+def site_positions(ts):
+	last = 0
+	for site in ts.sites():
+		pos = int(round(site.position))
+		if pos <= last:
+			pos = last + 1
+		last = pos
+		yield pos
+
+
+def pack_bed_block(block):
+	n_rows, n_cols = block.shape
+	quads = block.reshape(n_rows, n_cols // 4, 4)
+	packed = quads[:, :, 0] | (quads[:, :, 1] << 2) | (quads[:, :, 2] << 4) | (quads[:, :, 3] << 6)
+	return packed.astype(np.uint8).tobytes()
+
+
+def write_fam(prefix, n_ind):
+	with open(prefix + ".fam", "w") as fam:
+		for name in sample_names(n_ind):
+			fam.write(name + "\t" + name + "\t0\t0\t0\t-9\n")
+
+
+#Stream ts.variants() into a packed .bed, writing the matching .bim as we go
+#Consecutive sample nodes are paired into diploid individuals, as write_vcf(ploidy = 2) does
+#Memory use is bounded by block_size variants
+def write_plink(ts, prefix, chrom, block_size = 10000):
+	n_ind = ts.num_samples // 2
+	n_bytes = (n_ind + 3) // 4
+	write_fam(prefix, n_ind)
+
+	block = np.zeros((block_size, 4 * n_bytes), dtype = np.uint8)
+	k = 0
+	snp_id = 0
+	skipped = 0
+
+	with open(prefix + ".bed", "wb") as bed, open(prefix + ".bim", "w") as bim:
+		bed.write(bed_magic)
+		for variant, pos in zip(ts.variants(), site_positions(ts)):
+			if len(variant.alleles) != 2:
+				skipped += 1
+				continue
+			genotypes = variant.genotypes
+			dosage = genotypes[0::2] + genotypes[1::2]
+			block[k, :n_ind] = bed_codes[dosage]
+
+			snp_id += 1
+			bim.write(str(chrom) + "\t" + str(snp_id) + "\t0\t" + str(pos) + "\t" +
+			variant.alleles[1] + "\t" + variant.alleles[0] + "\n")
+
+			k += 1
+			if k == block_size:
+				bed.write(pack_bed_block(block[:k]))
+				k = 0
+		if k > 0:
+			bed.write(pack_bed_block(block[:k]))
+
+	if skipped > 0:
+		print("SKIPPED", skipped, "NON-BIALLELIC SITES", flush = True)
+	return snp_id
+
+
+#Same layout as pop_info_generator.py, written to the current directory
+def write_pop_info(n1, n2, n3, path):
+	names = sample_names(n1 + n2 + n3)
+	with open(path, "w") as file:
+		file.write("ID   col2    col3     POP     REGION\n")
+		for name in names[:n1]:
+			file.write(name + "  0     PAR1     0     PAR1\n")
+		for name in names[n1:n1 + n2]:
+			file.write(name + "  1     PAR2     1     PAR2\n")
+		for name in names[n1 + n2:]:
+			file.write(name + "  2      ADM       2     ADM\n")
+
+
+#A1 dosage for each 2-bit .bed code; -1 marks a missing call
+dosage_codes = np.array([2, -1, 1, 0], dtype = np.int8)
+
+
+def count_lines(path):
+	with open(path, "r") as file:
+		return sum(1 for _ in file)
+
+
+#Variants per block so that a block of the fileset holds about n_elements genotypes
+def block_rows(prefix, n_elements):
+	return max(1, n_elements // max(1, count_lines(prefix + ".fam")))
+
+
+#Read a SNP-major .bed back as blocks of A1 dosages (variants x individuals, int8)
+#Only block_size variants are decoded at a time
+def read_bed(prefix, block_size = 10000):
+	n_ind = count_lines(prefix + ".fam")
+	n_snps = count_lines(prefix + ".bim")
+	n_bytes = (n_ind + 3) // 4
+	shifts = np.array([0, 2, 4, 6], dtype = np.uint8)
+
+	with open(prefix + ".bed", "rb") as bed:
+		if bed.read(3) != bed_magic:
+			raise ValueError(prefix + ".bed is not a SNP-major plink file")
+		for start in range(0, n_snps, block_size):
+			m = min(block_size, n_snps - start)
+			raw = np.frombuffer(bed.read(m * n_bytes), dtype = np.uint8).reshape(m, n_bytes)
+			codes = (raw[:, :, None] >> shifts) & 3
+			yield dosage_codes[codes.reshape(m, 4 * n_bytes)[:, :n_ind]]
+
+
+#Copy the variants flagged in keep (one flag per .bim line) into a new fileset
+#The packed .bed records are copied as they are, block by block
+def write_bed_subset(prefix, out_prefix, keep, block_size = 10000):
+	n_bytes = (count_lines(prefix + ".fam") + 3) // 4
+	with open(prefix + ".fam", "r") as fam, open(out_prefix + ".fam", "w") as out:
+		out.write(fam.read())
+	with open(prefix + ".bim", "r") as bim, open(out_prefix + ".bim", "w") as out:
+		for line, kept in zip(bim, keep):
+			if kept:
+				out.write(line)
+	with open(prefix + ".bed", "rb") as bed, open(out_prefix + ".bed", "wb") as out:
+		if bed.read(3) != bed_magic:
+			raise ValueError(prefix + ".bed is not a SNP-major plink file")
+		out.write(bed_magic)
+		for start in range(0, len(keep), block_size):
+			flags = np.asarray(keep[start:start + block_size], dtype = bool)
+			records = np.frombuffer(bed.read(len(flags) * n_bytes), dtype = np.uint8).reshape(len(flags), n_bytes)
+			out.write(records[flags].tobytes())
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+#Per-stage resource accounting for a pipeline run, written out as run_report.json
+#
+#A stage's CPU time is what the whole process and its reaped children used while it ran (RUSAGE_SELF
+#and RUSAGE_CHILDREN), so thread pools, BLAS threads and external commands all count. Stages can run
+#at the same time (--jobs), and then that figure covers every stage running alongside: such stages are
+#marked cpu_shared, and the run's total is taken once over the whole run rather than summed over stages.
+#thread_cpu_time is the CPU of the stage's own thread alone (RUSAGE_THREAD).
+#Bytes passed through read()/write() come from /proc/thread-self/io, so they are the stage thread's.
+#External commands are measured from os.wait4 when they are reaped (their CPU time, peak RSS and
+#block I/O, including anything they started themselves). Peak RSS of the pipeline itself is the
+#process high-water mark when the stage finished.
+#
+#A command's peak RSS is only known when it is above the pipeline's own high-water mark at launch:
+#Linux carries the spawning process's figure over into the child's, so anything lower is reported as None.
+
+import json
+import resource
+import sys
+import threading
+import time
+
+#records of the stages run so far, in the order they finished
+stages = []
+#records of the stages running now
+active = []
+lock = threading.Lock()
+local = threading.local()
+
+
+def thread_cpu_time():
+	usage = resource.getrusage(resource.RUSAGE_THREAD)
+	return usage.ru_utime + usage.ru_stime
+
+
+#CPU of this process (all its threads) and of the children it has reaped
+def process_cpu_time():
+	own = resource.getrusage(resource.RUSAGE_SELF)
+	children = resource.getrusage(resource.RUSAGE_CHILDREN)
+	return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+#rchar/wchar: every byte this thread read or wrote, cached or not (zero where /proc has no io file)
+def thread_io():
+	counters = {'rchar': 0, 'wchar': 0}
+	try:
+		with open("/proc/thread-self/io", "r") as file:
+			for line in file:
+				name, value = line.split(":")
+				if name in counters:
+					counters[name] = int(value)
+	except OSError:
+		pass
+	return counters['rchar'], counters['wchar']
+
+
+def peak_rss():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+#Run func() as the named stage and keep its record; a failing stage is recorded, then re-raised
+def measure(name, chrom, func):
+	record = {'stage': name, 'chrom': str(chrom), 'status': 'ran', 'cpu_shared': False, 'commands': [], 'simulations': []}
+	local.record = record
+	start = time.time()
+	record['started'] = start
+	with lock:
+		if active:
+			record['cpu_shared'] = True
+			for other in active:
+				other['cpu_shared'] = True
+		active.append(record)
+	cpu = process_cpu_time()
+	thread_cpu = thread_cpu_time()
+	read_start, write_start = thread_io()
+	try:
+		return func()
+	except BaseException:
+		record['status'] = 'failed'
+		raise
+	finally:
+		read_end, write_end = thread_io()
+		record['wall_time'] = time.time() - start
+		record['cpu_time'] = process_cpu_time() - cpu
+		record['thread_cpu_time'] = thread_cpu_time() - thread_cpu
+		record['read_bytes'] = read_end - read_start
+		record['write_bytes'] = write_end - write_start
+		children = record['commands'] + [sim for sim in record['simulations'] if 'peak_rss' in sim]
+		record['peak_rss'] = max([peak_rss()] + [child['peak_rss'] for child in children if child['peak_rss']])
+		local.record = None
+		with lock:
+			active.remove(record)
+			stages.append(record)
+
+
+def skipped(name, chrom):
+	with lock:
+		stages.append({'stage': name, 'chrom': str(chrom), 'status': 'skipped'})
+
+
+#Wrap func so a thread started by a stage reports to that stage
+def inherit(func):
+	record = getattr(local, 'record', None)
+	def run(*args):
+		local.record = record
+		try:
+			return func(*args)
+		finally:
+			local.record = None
+	return run
+
+
+#An external command, from the rusage os.wait4 returned for it and our peak RSS when it was started
+def add_command(cmd, wall_time, usage, returncode, launch_rss):
+	record = getattr(local, 'record', None)
+	if record is None:
+		return
+	record['commands'].append({
+		'command': cmd,
+		'returncode': returncode,
+		'wall_time': wall_time,
+		'cpu_time': usage.ru_utime + usage.ru_stime,
+		'peak_rss': usage.ru_maxrss * 1024 if usage.ru_maxrss * 1024 > launch_rss else None,
+		'block_read_bytes': usage.ru_inblock * 512,
+		'block_write_bytes': usage.ru_oublock * 512
+		})
+
+
+#Size of a simulated tree sequence, plus the cost if it was simulated in a worker process
+def add_simulation(stats):
+	record = getattr(local, 'record', None)
+	if record is not None:
+		record['simulations'].append(stats)
+
+
+#The measured record of each stage in the report already at path, by stage and chromosome
+def previous_records(path):
+	try:
+		with open(path, "r") as file:
+			records = json.load(file)['stages']
+	except (OSError, ValueError, KeyError, TypeError):
+		return {}
+	measured = {}
+	for record in records:
+		if record.get('status') == 'skipped':
+			record = record.get('previous')
+		if record:
+			measured[(record['stage'], record['chrom'])] = record
+	return measured
+
+
+#Everything recorded since the last write goes to path, then the records are cleared
+#The run is taken to have started at started, or at its first recorded stage if that was earlier;
+#its CPU time is process_cpu_time() now less cpu_started, plus that of stages recorded before started
+#A stage skipped as up to date keeps what it cost when it last ran, from the report being replaced, as 'previous'
+def write(path, started, cpu_started):
+	with lock:
+		records = list(stages)
+		del stages[:]
+	measured = previous_records(path)
+	for record in records:
+		if record['status'] == 'skipped' and (record['stage'], record['chrom']) in measured:
+			record['previous'] = measured[(record['stage'], record['chrom'])]
+	ran = [record for record in records if record['status'] != 'skipped']
+	cpu_time = process_cpu_time() - cpu_started + sum(record['cpu_time'] for record in ran if record['started'] < started)
+	started = min([started] + [record['started'] for record in ran])
+	report = {
+		'argv': sys.argv,
+		'started': started,
+		'finished': time.time(),
+		'wall_time': time.time() - started,
+		'cpu_time': cpu_time,
+		'peak_rss': max([record['peak_rss'] for record in ran] + [0]),
+		'stages': records
+		}
+	with open(path, "w") as file:
+		json.dump(report, file, indent = 1)
+	return report
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+#Content-addressed cache of simulated tree sequences
+#Each entry is <cache_dir>/<sha256 of the model parameters>.trees
+#Entries are touched when they are read and the least recently used ones are
+#removed once the cache grows past its size limit
+
+import hashlib
+import json
+import os
+
+import tskit
+
+
+def cache_key(params):
+	blob = json.dumps(params, sort_keys = True)
+	return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def cache_path(cache_dir, key):
+	return os.path.join(cache_dir, key + ".trees")
+
+
+def load(cache_dir, key):
+	path = cache_path(cache_dir, key)
+	try:
+		ts = tskit.load(path)
+	except (FileNotFoundError, tskit.FileFormatError):
+		return None
+	#mark as recently used
+	os.utime(path)
+	return ts
+
+
+#Written to a temporary file first so a reader (or another worker) never sees a partial entry
+def store(cache_dir, key, ts, max_bytes):
+	os.makedirs(cache_dir, exist_ok = True)
+	path = cache_path(cache_dir, key)
+	tmp_path = path + ".tmp." + str(os.getpid())
+	ts.dump(tmp_path)
+	os.replace(tmp_path, path)
+	evict(cache_dir, max_bytes, keep = path)
+
+
+def evict(cache_dir, max_bytes, keep = None):
+	entries = []
+	for name in os.listdir(cache_dir):
+		if not name.endswith(".trees"):
+			continue
+		path = os.path.join(cache_dir, name)
+		try:
+			stat = os.stat(path)
+		except FileNotFoundError:
+			continue
+		entries.append((stat.st_mtime, stat.st_size, path))
+
+	total = sum(size for _, size, _ in entries)
+	for _, size, path in sorted(entries):
+		if total <= max_bytes:
+			break
+		if path == keep:
+			continue
+		try:
+			os.remove(path)
+			print("EVICTED FROM CACHE:", os.path.basename(path), flush = True)
+		except FileNotFoundError:
+			pass
+		total -= size
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+#Streams an msprime tree sequence, or a plink fileset, to VCF one site at a time
+#Sample names are set when the file is written, so no find/replace pass is needed afterwards
+#Paths ending in .gz are written BGZF-compressed with a tabix index, in the same pass
+
+import numpy as np
+
+import bgzf
+from plink_io import read_bed, sample_names, site_positions
+
+#phased diploid calls indexed by 2*first haplotype + second haplotype
+gt_strings = np.array(["0|0", "0|1", "1|0", "1|1"])
+
+#unphased calls indexed by plink dosage + 1 (dosage -1 is missing)
+dosage_strings = np.array(["./.", "0/0", "0/1", "1/1"])
+
+vcf_columns = "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t"
+
+
+def vcf_header(ts, chrom, names):
+	return ("##fileformat=VCFv4.2\n" +
+	"##source=model_admix\n" +
+	"##FILTER=<ID=PASS,Description=\"All filters passed\">\n" +
+	"##contig=<ID=" + str(chrom) + ",length=" + str(int(ts.sequence_length)) + ">\n" +
+	"##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">\n" +
+	vcf_columns + "\t".join(names) + "\n")
+
+
+#Plain text, or BGZF plus tabix index when the path ends in .gz
+#records yields (line, chrom, pos, ref_length)
+def write_records(path, header, records, level):
+	if path.endswith(".gz"):
+		return bgzf.write_indexed(path, header, records, level)
+	n_records = 0
+	with open(path, "w") as vcf:
+		vcf.write(header)
+		for line, _, _, _ in records:
+			vcf.write(line)
+			n_records += 1
+	return n_records
+
+
+#Consecutive sample nodes are paired into diploid individuals, as write_vcf(ploidy = 2) does
+#Positions and SNP IDs match the ones plink_io.write_plink puts in the .bim
+def write_vcf(ts, path, chrom, level = 6):
+	def records():
+		snp_id = 0
+		for variant, pos in zip(ts.variants(), site_positions(ts)):
+			if len(variant.alleles) != 2:
+				continue
+			genotypes = variant.genotypes
+			calls = gt_strings[2 * genotypes[0::2] + genotypes[1::2]]
+
+			snp_id += 1
+			yield (str(chrom) + "\t" + str(pos) + "\t" + str(snp_id) + "\t" +
+			variant.alleles[0] + "\t" + variant.alleles[1] + "\t.\tPASS\t.\tGT\t" +
+			"\t".join(calls) + "\n", chrom, pos, len(variant.alleles[0]))
+
+	return write_records(path, vcf_header(ts, chrom, sample_names(ts.num_samples // 2)), records(), level)
+
+
+#The VCF plink --recode vcf-iid writes for a fileset: REF is A2, ALT is A1, unphased calls,
+#samples named by IID, one contig line per chromosome as long as its last position
+def write_vcf_from_bed(prefix, path, level = 6, block_size = 10000):
+	with open(prefix + ".fam", "r") as fam:
+		names = [line.split()[1] for line in fam]
+	contigs = {}
+	with open(prefix + ".bim", "r") as bim:
+		for line in bim:
+			fields = line.split()
+			contigs[fields[0]] = max(contigs.get(fields[0], 0), int(fields[3]))
+	header = ("##fileformat=VCFv4.2\n" +
+	"##source=model_admix\n" +
+	"".join("##contig=<ID=" + chrom + ",length=" + str(length + 1) + ">\n" for chrom, length in contigs.items()) +
+	"##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">\n" +
+	vcf_columns + "\t".join(names) + "\n")
+
+	def records():
+		with open(prefix + ".bim", "r") as bim:
+			for block in read_bed(prefix, block_size):
+				for dosages in block:
+					chrom, snp_id, _, pos, a1, a2 = next(bim).split()
+					yield (chrom + "\t" + pos + "\t" + snp_id + "\t" + a2 + "\t" + a1 + "\t.\t.\t.\tGT\t" +
+					"\t".join(dosage_strings[dosages + 1]) + "\n", chrom, int(pos), len(a2))
+
+	return write_records(path, header, records(), level)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+##########################################################################################
+# Benchmarks for model_admix.py                                                          #
+#                                                                                        #
+# Runs the pipeline on fixed-seed scenarios (sample size per population x region length) #
+# and records wall time, CPU time and peak memory of every step, comparing them with a   #
+# stored baseline so slowdowns show up before a production run. Each scenario runs in    #
+# one process of its own, timed from inside it: the simulate stage as its ancestry,      #
+# mutation and writing steps, then every other stage, so no step pays for start-up.      #
+# plink and admixture are replaced by the stubs in benchmarks/stubs when not installed;  #
+# their stages are then marked as stubbed and only compared with stubbed baselines.      #
+##########################################################################################
+
+#Usage:
+#	python benchmarks/run_benchmarks.py --samples 10,100 --lengths 1,10
+#	python benchmarks/run_benchmarks.py --save-baseline     (record benchmarks/baseline.json)
+#	python benchmarks/run_benchmarks.py --admixture-engine numpy     (other model_admix.py options are passed on)
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+#importing it loads neither msprime nor tskit; the steps import them as they need them
+sys.path.insert(0, os.path.dirname(bench_dir))
+import model_admix as pipeline
+import run_report
+stub_dir = os.path.join(bench_dir, "stubs")
+baseline_path = os.path.join(bench_dir, "baseline.json")
+
+#Same model and seed in every scenario, only the sample sizes and region length change
+#Chromosome 1 is long enough for every region length
+model_args = ['10000', '10000', '5000', '6000', '0.3', '0.7', '1', 'constant']
+seed = 1
+
+#The external tool each step runs with the options in args (model_admix.py options), by step;
+#steps that run in-process with these options are left out
+def external_tools(args):
+	parser = argparse.ArgumentParser(add_help = False)
+	pipeline.add_options(parser)
+	options = vars(parser.parse_args(args))
+	tools = {'prune_mp': 'plink'}
+	if options['plink_convert']:
+		tools['write'] = 'plink'
+	if options['vcf_engine'] == 'plink':
+		tools['vcf'] = 'plink'
+	if options['pca_engine'] == 'plink':
+		tools['pca'] = 'plink'
+	if options['prune_engine'] == 'plink':
+		tools['prune'] = 'plink'
+		tools['make_beds'] = 'plink'
+	if options['freq_engine'] == 'plink':
+		tools['freq'] = 'plink'
+	if options['admixture_engine'] == 'admixture':
+		tools['admixture'] = 'admixture'
+	return tools
+
+#time differences below this many seconds are treated as noise
+min_time_difference = 0.25
+#and memory differences below this many bytes: a step starts with whatever the allocator kept of the
+#memory earlier steps freed, which varies from run to run
+min_memory_difference = 50e6
+
+
+def scenario_name(samples, length_mb):
+	return "n" + str(samples) + "_" + str(length_mb) + "mb"
+
+
+def scenario_args(samples, length_mb, extra_args):
+	return model_args + [str(samples)] * 3 + ['--seed', str(seed), '--length', str(int(length_mb * 1e6))] + extra_args
+
+
+#Peak RSS is read from VmHWM, which Linux lets a process reset, so each step gets its own peak
+#Where it can't be reset, the high-water mark of the whole process so far is used instead
+def reset_peak():
+	try:
+		with open("/proc/self/clear_refs", "w") as file:
+			file.write("5")
+		return True
+	except OSError:
+		return False
+
+def own_peak(resettable):
+	if resettable:
+		with open("/proc/self/status", "r") as file:
+			for line in file:
+				if line.startswith("VmHWM:"):
+					return int(line.split()[1]) * 1024
+	return run_report.peak_rss()
+
+
+#One scenario, in this process and in the current directory: the simulate stage as it runs in
+#simulate_chrom and write_chrom_files, split into its steps, then every other stage of the graph
+#Each step is measured by run_report, so the plink/admixture processes it waits for are counted too
+#Stops at the first failing step; returns the results by step
+def run_steps(samples, length_mb, extra_args):
+	pipeline.configure(vars(pipeline.build_parser().parse_args(scenario_args(samples, length_mb, extra_args))))
+	chrom = pipeline.chrom_list[0]
+	sizes = (pipeline.sample_pop1, pipeline.sample_pop2, pipeline.sample_pop3)
+	ancestry_seed, (mutation_seed,) = pipeline.derive_seeds(seed, chrom)
+	state = {}
+
+	def ancestry():
+		state['sim'] = pipeline.models[pipeline.dem_option](pipeline.pop1, pipeline.pop2, pipeline.pop3, pipeline.time_admix,
+		pipeline.prop_pop1, pipeline.prop_pop2, chrom, *sizes, random_seed = ancestry_seed)
+
+	def mutation():
+		state['sim'] = pipeline.place_region(pipeline.add_mutations(state['sim'], mutation_seed), chrom)
+
+	def write():
+		pipeline.write_chrom_files(state['sim'], chrom, pipeline.dem_option, *sizes,
+		plink_convert = pipeline.plink_convert, min_maf = pipeline.min_maf)
+
+	steps = [('ancestry', ancestry), ('mutation', mutation), ('write', write)]
+	steps += [(stage['name'], lambda stage = stage: stage['run'](chrom)) for stage in pipeline.stage_graph()]
+
+	results = {}
+	for name, step in steps:
+		resettable = reset_peak()
+		try:
+			run_report.measure(name, chrom, step)
+		except BaseException as error:
+			print(name.upper(), "FAILED:", repr(error), flush = True)
+		record = run_report.stages.pop()
+		commands = [command['peak_rss'] for command in record['commands'] if command['peak_rss']]
+		results[name] = {
+			'failed': record['status'] == 'failed',
+			'wall_time': record['wall_time'],
+			'cpu_time': record['cpu_time'],
+			'peak_rss': max([own_peak(resettable)] + commands)
+			}
+		print("STEP", name.upper(), round(record['wall_time'], 2), "S", flush = True)
+		if results[name]['failed']:
+			break
+	return results
+
+
+#Tools that are not on the PATH are replaced by the stubs
+def tool_env():
+	env = dict(os.environ)
+	stubbed = [tool for tool in ('plink', 'admixture') if shutil.which(tool) is None]
+	if stubbed:
+		env['PATH'] = stub_dir + os.pathsep + env.get('PATH', '')
+	return env, stubbed
+
+
+#Each scenario is one fresh process (this script with --run-scenario) in its own directory,
+#so peak memory and loaded modules never carry over from one scenario to the next
+def run_scenario(name, samples, length_mb, work_dir, env, stubbed, extra_args = []):
+	run_dir = os.path.join(work_dir, name)
+	os.makedirs(run_dir, exist_ok = True)
+	results_path = os.path.join(run_dir, "benchmark_steps.json")
+	cmd = [sys.executable, os.path.abspath(__file__), '--run-scenario', str(samples), str(length_mb), results_path] + extra_args
+
+	with open(os.path.join(run_dir, "benchmark.log"), "w") as log:
+		subprocess.run(cmd, cwd = run_dir, env = env, stdout = log, stderr = subprocess.STDOUT)
+	results = {}
+	if os.path.exists(results_path):
+		with open(results_path, "r") as file:
+			results = json.load(file)
+
+	external = external_tools(extra_args)
+	for step, result in results.items():
+		result['stubbed'] = external.get(step) in stubbed
+		print(name, step, round(result['wall_time'], 2), "S", round(result['peak_rss'] / 1e6), "MB", flush = True)
+	if scenario_failed(results):
+		print(name, "FAILED, SEE", os.path.join(run_dir, "benchmark.log"), flush = True)
+	return results
+
+
+def scenario_failed(results):
+	return not results or any(result['failed'] for result in results.values())
+
+
+#Steps slower (or bigger) than the baseline by more than the tolerance
+def compare(results, baseline, time_tolerance, memory_tolerance):
+	regressions = []
+	for scenario, scenario_results in results.items():
+		for step, result in scenario_results.items():
+			base = baseline.get(scenario, {}).get(step)
+			if base is None or base['stubbed'] != result['stubbed'] or result['failed']:
+				continue
+			if result['wall_time'] > base['wall_time'] * (1 + time_tolerance) + min_time_difference:
+				regressions.append(scenario + " " + step + ": wall time " + str(round(result['wall_time'], 2)) +
+				" s, baseline " + str(round(base['wall_time'], 2)) + " s")
+			if result['peak_rss'] > base['peak_rss'] * (1 + memory_tolerance) + min_memory_difference:
+				regressions.append(scenario + " " + step + ": peak RSS " + str(round(result['peak_rss'] / 1e6)) +
+				" MB, baseline " + str(round(base['peak_rss'] / 1e6)) + " MB")
+	return regressions
+
+
+def machine():
+	return {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()}
+
+
+def main():
+	parser = argparse.ArgumentParser(description = "Benchmark model_admix.py step by step")
+	parser.add_argument("--samples", default = "10,100,1000",
+		help = "sample sizes per population, comma separated (default 10,100,1000)")
+	parser.add_argument("--lengths", default = "1,10,50",
+		help = "region lengths in Mb, comma separated (default 1,10,50)")
+	parser.add_argument("--plink-convert", action = "store_true",
+		help = "benchmark the VCF -> plink --vcf -> fam_fix/bim_fix route instead of the direct writer (needs plink)")
+	parser.add_argument("--output", default = "benchmark_results.json",
+		help = "where to write the results (default benchmark_results.json)")
+	parser.add_argument("--save-baseline", action = "store_true",
+		help = "store these results as the baseline instead of comparing with it")
+	parser.add_argument("--time-tolerance", type = float, default = 0.25,
+		help = "allowed slowdown over the baseline as a fraction (default 0.25)")
+	parser.add_argument("--memory-tolerance", type = float, default = 0.25,
+		help = "allowed growth in peak RSS over the baseline as a fraction (default 0.25)")
+	parser.add_argument("--keep", action = "store_true",
+		help = "keep the scenario directories instead of deleting them")
+	#internal: run one scenario in this process and write its results (see run_scenario)
+	parser.add_argument("--run-scenario", nargs = 3, metavar = ('SAMPLES', 'LENGTH', 'RESULTS'), help = argparse.SUPPRESS)
+	args, pipeline_args = parser.parse_known_args()
+
+	if args.run_scenario:
+		samples, length_mb, results_path = args.run_scenario
+		results = run_steps(int(samples), float(length_mb) if '.' in length_mb else int(length_mb), pipeline_args)
+		with open(results_path, "w") as file:
+			json.dump(results, file, indent = 1)
+		return
+
+	env, stubbed = tool_env()
+	if stubbed:
+		print("STUBBED:", ", ".join(stubbed), flush = True)
+	if args.plink_convert and 'plink' in stubbed:
+		sys.exit("--plink-convert needs plink, which is not installed")
+	extra_args = (['--plink-convert'] if args.plink_convert else []) + pipeline_args
+	#fails here on an option model_admix.py doesn't know, rather than in every scenario
+	external_tools(extra_args)
+
+	work_dir = tempfile.mkdtemp(prefix = "model_admix_bench_")
+	results = {}
+	try:
+		for samples in [int(n) for n in args.samples.split(',')]:
+			for length_mb in [float(l) if '.' in l else int(l) for l in args.lengths.split(',')]:
+				name = "_".join([scenario_name(samples, length_mb)] + [arg.lstrip('-').replace('-', '_') for arg in extra_args])
+				results[name] = run_scenario(name, samples, length_mb, work_dir, env, stubbed, extra_args)
+	finally:
+		if args.keep:
+			print("SCENARIO DIRECTORIES KEPT IN", work_dir, flush = True)
+		else:
+			shutil.rmtree(work_dir, ignore_errors = True)
+
+	report = {'machine': machine(), 'seed': seed, 'model': model_args, 'scenarios': results}
+	with open(args.output, "w") as file:
+		json.dump(report, file, indent = 1, sort_keys = True)
+
+	if args.save_baseline:
+		#new scenarios are added to the baseline, existing ones replaced
+		baseline = {'scenarios': {}}
+		if os.path.exists(baseline_path):
+			with open(baseline_path, "r") as file:
+				baseline = json.load(file)
+		baseline['machine'] = machine()
+		baseline['scenarios'].update({name: scenario_results for name, scenario_results in results.items()
+			if not scenario_failed(scenario_results)})
+		with open(baseline_path, "w") as file:
+			json.dump(baseline, file, indent = 1, sort_keys = True)
+		print("BASELINE SAVED:", baseline_path, flush = True)
+		return
+
+	if not os.path.exists(baseline_path):
+		print("NO BASELINE TO COMPARE WITH, RUN WITH --save-baseline FIRST", flush = True)
+		return
+	with open(baseline_path, "r") as file:
+		baseline = json.load(file)
+	if baseline['machine'] != machine():
+		print("BASELINE RECORDED ON ANOTHER MACHINE:", baseline['machine'], flush = True)
+	unmatched = [name for name in results if name not in baseline['scenarios']]
+	if unmatched:
+		print("NOT IN THE BASELINE, NOT COMPARED:", ", ".join(unmatched), flush = True)
+	regressions = compare(results, baseline['scenarios'], args.time_tolerance, args.memory_tolerance)
+	for regression in regressions:
+		print("REGRESSION:", regression, flush = True)
+	failed = [name for name, scenario_results in results.items() if scenario_failed(scenario_results)]
+	print("BENCHMARKS FINISHED:", len(regressions), "REGRESSIONS,", len(failed), "FAILED SCENARIOS", flush = True)
+	sys.exit(1 if regressions or failed else 0)
+
+
+if __name__ == '__main__':
+	main()
@@ -19,20 +19,46 @@
 #NOTE: This program was written with msprime0.7
 #msprime 1.0 is now out and is much more user-friendly
 #however, the developers offer indefinite backwards compatibility with old APIs, therefore
-#this has not been updated. The msprime.simulate() option is analogous to the new
-#.demography and .sim_ancestry options
+#the models are still written with the old API. The msprime.simulate() option is analogous to the new
+#.demography and .sim_ancestry options, and --backend demography runs the same models through those
 
 #In 0.7 msprime also produced some VCF quirks which were not compatible with downstream
 #packages, therefore some scripts here were developed to modify the VCF output from msprime
 #To my knowledge this is no longer necessary with the new version
 
 ##required packages
+#msprime and tskit take most of a second to import, so the functions that need them import them
+#themselves: importing this module, --help and argument errors don't pay for them
 import numpy as np
 import subprocess
 import sys
 import os
-import pandas as pd
-import msprime
+import argparse
+import multiprocessing
+import shutil
+import functools
+import hashlib
+import json
+import threading
+import concurrent.futures
+import time
+import resource
+import importlib.util
+
+#helper modules live in Dependencies/ next to the helper scripts
+#(ts_cache, fstats and geno_export read tree sequences, so they are imported where they are used)
+dep_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Dependencies")
+sys.path.insert(0, dep_dir)
+import plink_io
+import vcf_io
+import bgzf
+import pca
+import ld_prune
+import allele_freq
+from bim_fix import fix_bim
+import estimate
+import run_report
+import ancestry
 
 ###Updated for 2021 manuscript Oct 2021####
 
@@ -55,31 +81,314 @@ import msprime
 #dem_option will tell the program to model constant size, recent collapse, recent expansion
 
 
-pd.set_option('display.max_columns', None)
-pd.set_option('display.max_rows', None)
-pd.set_option('display.width', None)
-pd.set_option('display.max_colwidth', None)
+#chromosome lengths and recombination rates from stdpopsim catalogue
+chroms = ['1','2','3','4','5','6','7','8','9','10','11','12','13','14','15','16','17','18',
+'19','20','21','22']
+
+length = ['248956422','242193529','198295559','190214555','181538259','170805979',
+'159345973','145138636','138394717','133797422','135086622','133275309','114364328',
+'107043718','101991189','90338345','83257441','80373285','58617616','64444167',
+'46709983','50818468']
+
+recomb_rate = ['1.14856e-08','1.10543e-08', '1.12796e-08','1.12312e-08','1.12809e-08',
+'1.12229e-08','1.17646e-08','1.14785e-08','1.17807e-08','1.33651e-08','1.17193e-08',
+'1.30502e-08','1.09149e-08','1.11973e-08','1.38358e-08','1.48346e-08','1.58249e-08',
+'1.5076e-08','1.82201e-08','1.71783e-08','1.30452e-08','1.4445e-08']
+
+#chromosome name -> (length, recombination rate)
+chrom_map = {c: (int(l), float(r)) for c, l, r in zip(chroms, length, recomb_rate)}
+
+#look up length and recombination rate by chromosome name
+def chrom_params(chrom):
+	if str(chrom) not in chrom_map:
+		raise ValueError("Chromosome " + str(chrom) + " is not in the chromosome table")
+	return chrom_map[str(chrom)]
+
+#Part of the chromosome to simulate, in real coordinates: all of it unless --start/--end,
+#--length or --scale narrow it down. The chromosome's own recombination rate applies throughout
+def chrom_region(chrom):
+	chrom_length, chrom_recomb_rate = chrom_params(chrom)
+	start = region_start or 0
+	if region_end is not None:
+		end = region_end
+	elif region_length is not None:
+		end = start + region_length
+	elif region_scale is not None:
+		end = start + chrom_length / region_scale
+	else:
+		end = chrom_length
+	end = int(min(end, chrom_length))
+	if end <= start:
+		raise ValueError("Region " + str(start) + "-" + str(end) + " is empty on chromosome " + str(chrom))
+	return int(start), end, chrom_recomb_rate
+
+#chromosomes can be given as 7, 1-22, 1,3,5 or all
+def parse_chroms(spec):
+	if spec == 'all':
+		return [int(c) for c in chroms]
+	chrom_list = []
+	for part in spec.split(','):
+		if '-' in part:
+			first, last = part.split('-')
+			chrom_list.extend(range(int(first), int(last) + 1))
+		else:
+			chrom_list.append(int(part))
+	for c in chrom_list:
+		chrom_params(c)
+	return chrom_list
+
+#pipeline stages in the order they run, see stage_graph()
+stage_names = ['simulate', 'diagnostics', 'vcf', 'pca', 'prune', 'make_beds', 'prune_mp', 'admixture', 'freq', 'export']
+
+#positional parameters of a run, in command line order
+run_param_names = ['pop1', 'pop2', 'pop3', 'time_admix', 'prop_pop1', 'prop_pop2', 'chrom', 'dem_option', 
+'sample_pop1', 'sample_pop2', 'sample_pop3']
+
+#Options of a run, for the command line and for configure()
+def add_options(parser):
+	parser.add_argument("--workers", type = int, default = 1, 
+		help = "number of chromosomes simulated in parallel when several are given")
+	parser.add_argument("--cache-dir", 
+		help = "reuse simulated tree sequences stored here when the parameters match")
+	parser.add_argument("--cache-size", type = float, default = 50, 
+		help = "size limit of the tree sequence cache in GB (default 50)")
+	parser.add_argument("--seed", type = int, 
+		help = "master seed; ancestry and mutation seeds for every chromosome and replicate are derived from it")
+	parser.add_argument("--replicates", type = int, 
+		help = "simulate this many independent replicates, each run through the pipeline in its own rep_N directory")
+	parser.add_argument("--subsample", type = int, nargs = 3, action = "append", metavar = ('N1', 'N2', 'N3'), 
+		help = "also produce a dataset with this many individuals of pop1, pop2 and the admixed population, taken from the same simulation with ts.simplify and run through the pipeline in subsample_N1_N2_N3; repeat for several")
+	parser.add_argument("--mutation-replicates", type = int, 
+		help = "also overlay this many new sets of mutations (own seeds) on the same ancestry, each run through the pipeline in mutrep_K")
+	parser.add_argument("--mutation-rates", 
+		help = "comma separated mutation rates for --mutation-replicates (default the model's 1.29e-8); each rate and replicate goes in mutrep_RATE_K")
+	parser.add_argument("--from", dest = "run_from", choices = stage_names, 
+		help = "rerun this stage and every stage that depends on it, skipping the ones before it")
+	parser.add_argument("--only", 
+		help = "rerun only these stages (comma separated: " + ", ".join(stage_names) + ")")
+	parser.add_argument("--force", action = "store_true", 
+		help = "rerun every stage even if its outputs are up to date")
+	parser.add_argument("--check", choices = ['mtime', 'hash'], default = 'mtime', 
+		help = "a stage is up to date if its outputs are newer than its inputs (mtime) or its inputs are unchanged since it last ran (hash)")
+	parser.add_argument("--jobs", type = int, default = 1, 
+		help = "number of independent stages and external commands run at the same time (default 1)")
+	parser.add_argument("--plink-threads", type = int, 
+		help = "--threads given to each plink and admixture run (default: cores divided by --jobs)")
+	parser.add_argument("--plink-memory", type = int, 
+		help = "--memory in MB given to each plink run (default: plink's own choice)")
+	parser.add_argument("--pca-engine", choices = ['numpy', 'plink'], default = 'numpy', 
+		help = "run the PCA in-process with a randomized SVD (numpy, default) or with plink --pca")
+	parser.add_argument("--prune-engine", choices = ['plink', 'numpy'], default = 'plink', 
+		help = "LD-prune with plink --indep-pairwise (plink, default) or in-process (numpy, not checked against plink's lists); both use windows of 50, step 2, r2 0.8")
+	parser.add_argument("--maf", type = float, 
+		help = "leave sites with a minor allele frequency below this out of every output file, using the allele counts of the simulated samples")
+	parser.add_argument("--freq-engine", choices = ['tskit', 'plink'], default = 'tskit', 
+		help = "MAF 0.05 stage from the simulated allele counts (tskit, default) or with plink --maf")
+	parser.add_argument("--vcf-engine", choices = ['native', 'plink'], default = 'native', 
+		help = "write snps_CHROM.vcf.gz from the fileset in-process (native, default) or with plink --recode vcf-iid bgz")
+	parser.add_argument("--vcf-level", type = int, choices = range(10), default = 6, metavar = "{0-9}", 
+		help = "compression level of the BGZF VCFs (default 6; 0 stores the blocks uncompressed)")
+	parser.add_argument("--export", choices = ['npy', 'zarr'], 
+		help = "add an export stage writing the genotype matrix (sites x haplotypes) with positions, alleles, sample IDs and populations as memory-mappable .npy files or a chunked Zarr group")
+	parser.add_argument("--export-packed", action = "store_true", 
+		help = "bit-pack the exported genotype matrix, 8 haplotypes per byte, instead of one int8 per haplotype")
+	parser.add_argument("--admixture-engine", choices = ['admixture', 'numpy'], default = 'admixture', 
+		help = "estimate ancestry proportions for K = 1, 2 and 3 with the admixture binary (default) or in-process with an accelerated EM on blocks of SNPs over --plink-threads threads (numpy)")
+	parser.add_argument("--max-alpha-error", type = float, 
+		help = "stop before ADMIXTURE if the pop1 admixture proportion estimated from f2 statistics is further than this from prop_pop1")
+	parser.add_argument("--backend", choices = ['legacy', 'demography'], default = 'legacy', 
+		help = "msprime API: legacy simulate/mutate (default, reproduces earlier seeds) or msprime 1.x Demography with sim_ancestry/sim_mutations")
+	parser.add_argument("--ancestry-model", choices = ['hudson', 'smc', 'smc_prime', 'dtwf'], default = 'hudson', 
+		help = "ancestry model for the demography backend (default hudson)")
+	parser.add_argument("--discrete-genome", action = "store_true", 
+		help = "integer breakpoints and site positions (demography backend); the legacy API only has a continuous genome")
+	parser.add_argument("--mutation-model", choices = ['jc69', 'binary'], default = 'jc69', 
+		help = "mutation model for the demography backend: jc69 nucleotides (default) or a two-state A/T model")
+	parser.add_argument("--start", type = int, 
+		help = "simulate from this position (bp) of the chromosome instead of its beginning")
+	parser.add_argument("--end", type = int, 
+		help = "simulate up to this position (bp); single chromosome only")
+	parser.add_argument("--length", type = int, 
+		help = "simulate this many bp from --start (or the beginning) of each chromosome")
+	parser.add_argument("--scale", type = float, 
+		help = "simulate 1/SCALE of each chromosome from --start (or the beginning), at the chromosome's own rates, for quick test runs")
+	parser.add_argument("--estimate", action = "store_true", 
+		help = "check the demography and predict trees, sites, file sizes, wall time and peak memory from short calibration runs, then stop")
+	parser.add_argument("--plink-convert", action = "store_true", 
+		help = "build the plink fileset through VCF, plink --vcf, fam_fix.pl and bim_fix.py instead of writing it directly")
 
-pop1 = int(sys.argv[1]) #pop1 initial size
-pop2 = int(sys.argv[2]) #pop2 initial size
-pop3 = int(sys.argv[3]) #adm initial size
-time_admix = int(sys.argv[4])
-prop_pop1 = float(sys.argv[5]) #pop1 admixture proportion
-prop_pop2 = float(sys.argv[6]) #pop2 admixture proportion
-chrom = int(sys.argv[7]) #chromosome
-dem_option = sys.argv[8] #which model?
-sample_pop1 = int(sys.argv[9]) #specify sample size for ancestor 1
-sample_pop2 = int(sys.argv[10]) #specify sample size for ancestor 2
-sample_pop3 = int(sys.argv[11]) #specify sample size for admixed population
+def build_parser():
+	parser = argparse.ArgumentParser(description = "Simulate admixture between two parent populations with msprime")
+	parser.add_argument("pop1", type = int, help = "pop1 initial size")
+	parser.add_argument("pop2", type = int, help = "pop2 initial size")
+	parser.add_argument("pop3", type = int, help = "adm initial size")
+	parser.add_argument("time_admix", type = int, help = "time of admixture in years ago")
+	parser.add_argument("prop_pop1", type = float, help = "pop1 admixture proportion")
+	parser.add_argument("prop_pop2", type = float, help = "pop2 admixture proportion")
+	parser.add_argument("chrom", help = "chromosome, or a list/range of chromosomes (e.g. 1-22, 1,3,5 or all)")
+	parser.add_argument("dem_option", choices = ['constant', 'collapse', 'expansion'], help = "which model?")
+	parser.add_argument("sample_pop1", type = int, help = "sample size for ancestor 1")
+	parser.add_argument("sample_pop2", type = int, help = "sample size for ancestor 2")
+	parser.add_argument("sample_pop3", type = int, help = "sample size for admixed population")
+	add_options(parser)
+	return parser
 
-if not os.path.exists("Admixture/"):
-	os.mkdir("Admixture/")
+#Every option at its command line default
+def default_options():
+	parser = argparse.ArgumentParser(add_help = False)
+	add_options(parser)
+	return vars(parser.parse_args([]))
+
+#Set the run parameters and options every function here reads from params, a dict of the command
+#line's parameters by name, e.g. {'pop1': 10000, ..., 'chrom': 22, ..., 'seed': 1, 'scale': 100}
+#Options left out take their defaults; lists may be given for chrom, only and mutation_rates
+#Raises ValueError for missing, unknown or conflicting parameters
+def configure(params):
+	global pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom_list, dem_option, sample_pop1, sample_pop2, sample_pop3
+	global workers, plink_convert, cache_dir, cache_size, seed, replicates, subsamples, mutation_rates, mutation_replicates
+	global run_from, only, force, check, jobs, plink_threads, plink_memory, command_slots
+	global pca_engine, prune_engine, freq_engine, vcf_engine, admixture_engine, vcf_level, export_format, export_packed, min_maf, max_alpha_error
+	global backend, ancestry_model, discrete_genome, mutation_model, estimate_only, region_start, region_end, region_length, region_scale
+	
+	options = default_options()
+	missing = [name for name in run_param_names if name not in params]
+	if missing:
+		raise ValueError("missing parameters: " + ", ".join(missing))
+	unknown = [name for name in params if name not in run_param_names and name not in options]
+	if unknown:
+		raise ValueError("unknown parameters: " + ", ".join(unknown))
+	options.update(params)
+	
+	#lists can be given as the command line's comma separated strings or as Python lists
+	def as_spec(value):
+		return value if isinstance(value, str) else ",".join(str(v) for v in np.atleast_1d(value))
+	
+	pop1 = options['pop1'] #pop1 initial size
+	pop2 = options['pop2'] #pop2 initial size
+	pop3 = options['pop3'] #adm initial size
+	time_admix = options['time_admix']
+	prop_pop1 = options['prop_pop1'] #pop1 admixture proportion
+	prop_pop2 = options['prop_pop2'] #pop2 admixture proportion
+	chrom_list = parse_chroms(as_spec(options['chrom'])) #chromosome(s)
+	dem_option = options['dem_option'] #which model?
+	sample_pop1 = options['sample_pop1'] #specify sample size for ancestor 1
+	sample_pop2 = options['sample_pop2'] #specify sample size for ancestor 2
+	sample_pop3 = options['sample_pop3'] #specify sample size for admixed population
+	workers = options['workers']
+	plink_convert = options['plink_convert']
+	cache_dir = os.path.abspath(options['cache_dir']) if options['cache_dir'] else None
+	cache_size = options['cache_size']
+	seed = options['seed']
+	replicates = options['replicates']
+	subsamples = [list(sizes) for sizes in options['subsample'] or []]
+	mutation_rates = [float(rate) for rate in as_spec(options['mutation_rates']).split(',')] if options['mutation_rates'] else None
+	mutation_replicates = options['mutation_replicates'] or (1 if mutation_rates else None)
+	run_from = options['run_from']
+	only = as_spec(options['only']).split(',') if options['only'] else None
+	force = options['force']
+	check = options['check']
+	jobs = options['jobs']
+	plink_threads = options['plink_threads'] or max(1, (os.cpu_count() or 1) // jobs)
+	plink_memory = options['plink_memory']
+	
+	#external commands wait for a free slot, so at most --jobs of them run at once
+	command_slots = threading.BoundedSemaphore(jobs)
+	
+	pca_engine = options['pca_engine']
+	prune_engine = options['prune_engine']
+	freq_engine = options['freq_engine']
+	vcf_engine = options['vcf_engine']
+	admixture_engine = options['admixture_engine']
+	vcf_level = options['vcf_level']
+	export_format = options['export']
+	export_packed = options['export_packed']
+	min_maf = options['maf']
+	max_alpha_error = options['max_alpha_error']
+	backend = options['backend']
+	ancestry_model = options['ancestry_model']
+	discrete_genome = options['discrete_genome']
+	mutation_model = options['mutation_model']
+	estimate_only = options['estimate']
+	region_start = options['start']
+	region_end = options['end']
+	region_length = options['length']
+	region_scale = options['scale']
 	
-os.chdir("Admixture/")
+	if dem_option not in models:
+		raise ValueError("dem_option must be one of " + ", ".join(models))
+	if sum(option is not None for option in (region_end, region_length, region_scale)) > 1:
+		raise ValueError("give only one of --end, --length and --scale")
+	if region_end is not None and len(chrom_list) > 1:
+		raise ValueError("--end needs a single chromosome, use --length or --scale for several")
+	if region_scale is not None and region_scale < 1:
+		raise ValueError("--scale must be at least 1")
+	for c in chrom_list:
+		chrom_region(c)
+	
+	for sizes in subsamples:
+		if not all(1 <= n <= full for n, full in zip(sizes, (sample_pop1, sample_pop2, sample_pop3))):
+			raise ValueError("--subsample sizes must be between 1 and the simulated sample sizes (" + 
+			" ".join(str(n) for n in (sample_pop1, sample_pop2, sample_pop3)) + ")")
+	if (subsamples or mutation_replicates) and replicates is not None:
+		raise ValueError("--subsample and --mutation-replicates cannot be combined with --replicates")
+	if mutation_replicates is not None and mutation_replicates < 1:
+		raise ValueError("--mutation-replicates must be at least 1")
+	if mutation_rates and min(mutation_rates) <= 0:
+		raise ValueError("--mutation-rates must be positive")
+	
+	if backend == 'legacy' and (ancestry_model != 'hudson' or discrete_genome or mutation_model != 'jc69'):
+		raise ValueError("--ancestry-model, --discrete-genome and --mutation-model need --backend demography")
+	
+	if run_from is not None and run_from not in stage_names:
+		raise ValueError("unknown stage " + run_from + " (choose from " + ", ".join(stage_names) + ")")
+	for name in only or []:
+		if name not in stage_names:
+			raise ValueError("unknown stage " + name + " (choose from " + ", ".join(stage_names) + ")")
+	
+	if export_format is None and (export_packed or 'export' in (only or []) or run_from == 'export'):
+		raise ValueError("--export-packed and the export stage need --export npy or --export zarr")
+	if export_format == 'zarr' and importlib.util.find_spec("zarr") is None:
+		raise ValueError("--export zarr needs the zarr package (pip install zarr), or use --export npy")
+
+default_mutation_seed = 145697 #used when no master seed is given
 
 #Simulation function
 
-def model_admix_constant(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom, sample_pop1, sample_pop2, sample_pop3):
+mutation_rate = 1.29e-8 #human mutation rate
+
+#Every model goes through here, with the populations and events in msprime 0.7 form
+#The demography backend converts them to an msprime 1.x Demography, which keeps the same sizes,
+#growth rates and event order, and samples each population's individuals as diploids (ploidy 2
+#is also the time scale of the legacy API), so sample nodes come out in the same order
+#Mutations are added separately (add_mutations), so none are placed here
+def simulate_demography(random_seed, num_replicates, length, recombination_rate, population_configurations, migration_matrix, demographic_events):
+	import msprime
+	if backend == 'legacy':
+		return msprime.simulate(
+			random_seed = random_seed,
+			num_replicates = num_replicates,
+			length = length,
+			recombination_rate = recombination_rate,
+			population_configurations = population_configurations,
+			migration_matrix = migration_matrix,
+			demographic_events = demographic_events)
+	
+	demography = msprime.Demography.from_old_style(population_configurations, 
+		migration_matrix = migration_matrix, demographic_events = demographic_events, 
+		ignore_sample_size = True)
+	return msprime.sim_ancestry(
+		samples = {k: config.sample_size // 2 for k, config in enumerate(population_configurations)},
+		demography = demography,
+		ploidy = 2,
+		sequence_length = length,
+		recombination_rate = recombination_rate,
+		discrete_genome = discrete_genome,
+		model = ancestry_model,
+		random_seed = random_seed,
+		num_replicates = num_replicates)
+
+def model_admix_constant(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom, sample_pop1, sample_pop2, sample_pop3, random_seed = None, num_replicates = None, simulator = None):
+	import msprime
 
 	
 	#defining the variables for the simulation by scaling to args			
@@ -99,34 +408,19 @@ def model_admix_constant(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chr
 	m_Pop1 = 0.1*prop_pop1
 	m_Pop2 = 0.1*prop_pop2
 	
-	chroms = ['1','2','3','4','5','6','7','8','9','10','11','12','13','14','15','16','18',
-	'19','20','21','22']
-	
-	length = ['248956422','242193529','198295559','190214555','181538259','170805979',
-	'159345973','145138636','138394717','133797422','135086622','133275309','114364328',
-	'107043718','101991189','90338345','83257441','80373285','58617616','64444167',
-	'46709983','50818468']
-	
-	recomb_rate = ['1.14856e-08','1.10543e-08', '1.12796e-08','1.12312e-08','1.12809e-08',
-	'1.12229e-08','1.17646e-08','1.14785e-08','1.17807e-08','1.33651e-08','1.17193e-08',
-	'1.30502e-08','1.09149e-08','1.11973e-08','1.38358e-08','1.48346e-08','1.58249e-08',
-	'1.5076e-08','1.82201e-08','1.71783e-08','1.30452e-08','1.4445e-08']
-	
-	chrom_tuple = list(zip(chroms, length, recomb_rate))
-	chrom_map = pd.DataFrame(chrom_tuple, columns = ['chroms', 'length', 'recomb_rate'])
+	chrom_start, chrom_end, chrom_recomb_rate = chrom_region(chrom)
 	
-	chrom_map_pos = (1-int(chrom))
-	
-	chrom_recomb_rate = chrom_map.iloc[chrom_map_pos]['recomb_rate']
-	chrom_length = chrom_map.iloc[chrom_map_pos]['length']
-	
-	print("BEGINNING SIMULATION:", str(sys.argv), flush = True)
+	print("BEGINNING SIMULATION:", str([pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, sample_pop1, sample_pop2, sample_pop3]), 
+	"CHROMOSOME", chrom, flush = True)
 
 	#begin simulation
-	sim = msprime.simulate(
-		length = int(chrom_length), 
+	#returns a generator of tree sequences when num_replicates is set
+	#simulator receives the model's populations and events instead (see estimate_chrom)
+	sim = (simulator or simulate_demography)(
+		random_seed = random_seed,
+		num_replicates = num_replicates,
+		length = chrom_end - chrom_start, 
 		recombination_rate = float(chrom_recomb_rate),
-		mutation_rate = 1.29e-8, #human mutation rate
 		population_configurations = [
 		msprime.PopulationConfiguration(
 			sample_size = (2*int(sample_pop1)), 
@@ -240,44 +534,11 @@ def model_admix_constant(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chr
 	 			]
 	 			)
 	
-	model = msprime.InfiniteSites(msprime.NUCLEOTIDES)
-	sim = msprime.mutate(sim, rate = 1.29e-8, model = model, random_seed = 145697)
-	
-	print("SIMULATION COMPLETE", flush = True)
-
-	#Make VCF of simulated data
-	with open("snps_" + str(chrom) + ".vcf", "w") as vcf_file: 
-		sim.write_vcf(vcf_file, 2)
-
-	#msprime makes files that aren't quite compatible with what we need to do
-	#Therefore we'll need to clean these files up before proceeding
-	with open("snps_" + str(chrom) + ".vcf", "r") as file: 
-		filedata = file.read()
-		
-	filedata = filedata.replace("tsk_0", "tsk_00")
-	
-	with open ("snps_" + str(chrom) + ".vcf", "w") as file: 
-		file.write(filedata)
-	
-	print("VCF FIXED", flush = True)
-	
-	#Make files compatible for plink	
-	os.system("../Dependencies/pop_info_generator.py " + str(sample_pop1) + ' ' + 
-	str(sample_pop2) + ' ' + str(sample_pop3))
-		
-	make_files = subprocess.Popen(
-		"plink --vcf snps_" + str(chrom) + ".vcf --make-bed --out model_" + str(chrom), 
-		shell=True
-		)
-
-	#Create population information for the simulated data
-	print("POP INFO CREATED", flush = True)
-	
-	make_files.communicate()
-	print("FILES CREATED", flush = True)
+	return sim
 
 
-def model_admix_expansion(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom, sample_pop1, sample_pop2, sample_pop3):
+def model_admix_expansion(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom, sample_pop1, sample_pop2, sample_pop3, random_seed = None, num_replicates = None, simulator = None):
+	import msprime
 
 	
 	#defining the variables for the simulation by scaling to args			
@@ -297,35 +558,19 @@ def model_admix_expansion(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, ch
 	m_Pop1 = 0.1*prop_pop1
 	m_Pop2 = 0.1*prop_pop2
 	
-	chroms = ['1','2','3','4','5','6','7','8','9','10','11','12','13','14','15','16','18',
-	'19','20','21','22']
-	
-	length = ['248956422','242193529','198295559','190214555','181538259','170805979',
-	'159345973','145138636','138394717','133797422','135086622','133275309','114364328',
-	'107043718','101991189','90338345','83257441','80373285','58617616','64444167',
-	'46709983','50818468']
-	
-	recomb_rate = ['1.14856e-08','1.10543e-08', '1.12796e-08','1.12312e-08','1.12809e-08',
-	'1.12229e-08','1.17646e-08','1.14785e-08','1.17807e-08','1.33651e-08','1.17193e-08',
-	'1.30502e-08','1.09149e-08','1.11973e-08','1.38358e-08','1.48346e-08','1.58249e-08',
-	'1.5076e-08','1.82201e-08','1.71783e-08','1.30452e-08','1.4445e-08']
-	
-	chrom_tuple = list(zip(chroms, length, recomb_rate))
-	chrom_map = pd.DataFrame(chrom_tuple, columns = ['chroms', 'length', 'recomb_rate'])
-	
-	chrom_map_pos = (1-int(chrom))
+	chrom_start, chrom_end, chrom_recomb_rate = chrom_region(chrom)
 	
-	chrom_recomb_rate = chrom_map.iloc[chrom_map_pos]['recomb_rate']
-	chrom_length = chrom_map.iloc[chrom_map_pos]['length']
-	
-	print("BEGINNING SIMULATION:", str(sys.argv), flush = True)
+	print("BEGINNING SIMULATION:", str([pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, sample_pop1, sample_pop2, sample_pop3]), 
+	"CHROMOSOME", chrom, flush = True)
 
 	#begin simulation
-	
-	sim = msprime.simulate(
-		length = int(chrom_length), 
+	#returns a generator of tree sequences when num_replicates is set
+	#simulator receives the model's populations and events instead (see estimate_chrom)
+	sim = (simulator or simulate_demography)(
+		random_seed = random_seed,
+		num_replicates = num_replicates,
+		length = chrom_end - chrom_start, 
 		recombination_rate = float(chrom_recomb_rate),
-		mutation_rate = 1.29e-8, #human mutation rate
 		population_configurations = [
 		msprime.PopulationConfiguration(
 			sample_size = (2*int(sample_pop1)), 
@@ -440,45 +685,12 @@ def model_admix_expansion(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, ch
 	 			]
 	 			)
 	
-	model = msprime.InfiniteSites(msprime.NUCLEOTIDES)
-	sim = msprime.mutate(sim, rate = 1.29e-8, model = model, random_seed = 145697)
-		
-	print("SIMULATION COMPLETE", flush = True)
-
-	#Make VCF of simulated data
-	with open("snps_" + str(chrom) + ".vcf", "w") as vcf_file: 
-		sim.write_vcf(vcf_file, 2)
-
-	#msprime makes files that aren't quite compatible with what we need to do
-	#Therefore we'll need to clean these files up before proceeding
-	with open("snps_" + str(chrom) + ".vcf", "r") as file: 
-		filedata = file.read()
-		
-	filedata = filedata.replace("tsk_0", "tsk_00")
-	
-	with open ("snps_" + str(chrom) + ".vcf", "w") as file: 
-		file.write(filedata)
-	
-	print("VCF FIXED", flush = True)
-	
-	#Make files compatible for plink	
-	os.system("../Dependencies/pop_info_generator.py " + str(sample_pop1) + ' ' + 
-	str(sample_pop2) + ' ' + str(sample_pop3))
-		
-	make_files = subprocess.Popen(
-		"plink --vcf snps_" + str(chrom) + ".vcf --make-bed --out model_" + str(chrom), 
-		shell=True
-		)
+	return sim
 
-	#Create population information for the simulated data
-	print("POP INFO CREATED", flush = True)
-	
-	make_files.communicate()
-	print("FILES CREATED", flush = True)
 
 
-
-def model_admix_collapse(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom, sample_pop1, sample_pop2, sample_pop3):
+def model_admix_collapse(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom, sample_pop1, sample_pop2, sample_pop3, random_seed = None, num_replicates = None, simulator = None):
+	import msprime
 
 	
 	#defining the variables for the simulation by scaling to args			
@@ -498,35 +710,19 @@ def model_admix_collapse(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chr
 	m_Pop1 = 0.1*prop_pop1
 	m_Pop2 = 0.1*prop_pop2
 	
-	chroms = ['1','2','3','4','5','6','7','8','9','10','11','12','13','14','15','16','18',
-	'19','20','21','22']
-	
-	length = ['248956422','242193529','198295559','190214555','181538259','170805979',
-	'159345973','145138636','138394717','133797422','135086622','133275309','114364328',
-	'107043718','101991189','90338345','83257441','80373285','58617616','64444167',
-	'46709983','50818468']
-	
-	recomb_rate = ['1.14856e-08','1.10543e-08', '1.12796e-08','1.12312e-08','1.12809e-08',
-	'1.12229e-08','1.17646e-08','1.14785e-08','1.17807e-08','1.33651e-08','1.17193e-08',
-	'1.30502e-08','1.09149e-08','1.11973e-08','1.38358e-08','1.48346e-08','1.58249e-08',
-	'1.5076e-08','1.82201e-08','1.71783e-08','1.30452e-08','1.4445e-08']
-	#chromosome lengths and recombination rates from stdpopsim catalogue
-	
-	chrom_tuple = list(zip(chroms, length, recomb_rate))
-	chrom_map = pd.DataFrame(chrom_tuple, columns = ['chroms', 'length', 'recomb_rate'])
-	
-	chrom_map_pos = (1-int(chrom))
-	
-	chrom_recomb_rate = chrom_map.iloc[chrom_map_pos]['recomb_rate']
-	chrom_length = chrom_map.iloc[chrom_map_pos]['length']
+	chrom_start, chrom_end, chrom_recomb_rate = chrom_region(chrom)
 	
-	print("BEGINNING SIMULATION:", str(sys.argv), flush = True)
+	print("BEGINNING SIMULATION:", str([pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, sample_pop1, sample_pop2, sample_pop3]), 
+	"CHROMOSOME", chrom, flush = True)
 
 	#begin simulation
-	sim = msprime.simulate(
-		length = int(chrom_length), 
+	#returns a generator of tree sequences when num_replicates is set
+	#simulator receives the model's populations and events instead (see estimate_chrom)
+	sim = (simulator or simulate_demography)(
+		random_seed = random_seed,
+		num_replicates = num_replicates,
+		length = chrom_end - chrom_start, 
 		recombination_rate = float(chrom_recomb_rate),
-		mutation_rate = 1.29e-8, #human mutation rate
 		population_configurations = [
 		msprime.PopulationConfiguration(
 			sample_size = (2*int(sample_pop1)), 
@@ -649,50 +845,57 @@ def model_admix_collapse(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chr
 	 			]
 	 			)
 	 			
-	model = msprime.InfiniteSites(msprime.NUCLEOTIDES)
-	sim = msprime.mutate(sim, rate = 1.29e-8, model = model, random_seed = 145697)
+	return sim
 	
-	 	 		
-	print("SIMULATION COMPLETE", flush = True)
+#Every external tool runs through here
+#Its resource use (and that of anything it starts) is collected when it is reaped, for run_report.json
+def run_command(cmd):
+	with command_slots:
+		start = time.time()
+		launch_rss = run_report.peak_rss()
+		proc = subprocess.Popen(cmd, shell = True)
+		_, status, usage = os.wait4(proc.pid, 0)
+		proc.returncode = os.waitstatus_to_exitcode(status)
+	run_report.add_command(cmd, time.time() - start, usage, proc.returncode, launch_rss)
+	return proc.returncode
 
-	#Make VCF of simulated data
-	with open("snps_" + str(chrom) + ".vcf", "w") as vcf_file: 
-		sim.write_vcf(vcf_file, 2)
+#Independent commands side by side, still limited by --jobs
+def run_parallel(cmds):
+	with concurrent.futures.ThreadPoolExecutor(len(cmds)) as pool:
+		return list(pool.map(run_report.inherit(run_command), cmds))
 
-	#msprime makes files that aren't quite compatible with what we need to do
-	#Therefore we'll need to clean these files up before proceeding
-	with open("snps_" + str(chrom) + ".vcf", "r") as file: 
-		filedata = file.read()
-		
-	filedata = filedata.replace("tsk_0", "tsk_00")
-	
-	with open ("snps_" + str(chrom) + ".vcf", "w") as file: 
-		file.write(filedata)
-	
-	print("VCF FIXED", flush = True)
+#plink with the per-run thread and memory budget
+def plink(args):
+	budget = " --threads " + str(plink_threads)
+	if plink_memory:
+		budget += " --memory " + str(plink_memory)
+	return run_command("plink " + args + budget)
+
+#Legacy output step: VCF, plink --vcf, then fam_fix and bim_fix clean up the fileset
+def make_plink_files(sim, chrom, double_id = False):
+
+	#Make VCF of simulated data
+	#Sample names are set as the file is streamed out, so there is nothing to fix up afterwards
+	#It is written BGZF-compressed with its tabix index, and plink reads the compressed file as it is
+	vcf_io.write_vcf(sim, "snps_" + str(chrom) + ".vcf.gz", chrom, vcf_level)
+	print("VCF WRITTEN", flush = True)
 	
 	#Make files compatible for plink	
-	os.system("../Dependencies/pop_info_generator.py " + str(sample_pop1) + ' ' + 
-	str(sample_pop2) + ' ' + str(sample_pop3))
-		
-	make_files = subprocess.Popen(
-		"plink --vcf snps_" + str(chrom) + ".vcf --make-bed --double-id --out model_" + str(chrom), 
-		shell=True
-		)
+	plink("--vcf snps_" + str(chrom) + ".vcf.gz --make-bed " + ("--double-id " if double_id else "") + 
+		"--out model_" + str(chrom))
 
-	#Create population information for the simulated data
-	print("POP INFO CREATED", flush = True)
-	
-	make_files.communicate()
-	print("FILES CREATED", flush = True)
+def make_pop_info(sample_pop1, sample_pop2, sample_pop3):
+	plink_io.write_pop_info(sample_pop1, sample_pop2, sample_pop3, "population_information.txt")
+
+models = {
+	'constant': model_admix_constant,
+	'collapse': model_admix_collapse,
+	'expansion': model_admix_expansion
+	}
 	
 #We'll need to do a bit more file prep before we're ready to get moving on analysis
-def fam_fix():
-	fam_fix = subprocess.Popen(
-		"../Dependencies/fam_fix.pl ../Admixture/model_" + str(chrom) + ".fam ../Admixture/model_" + str(chrom) + "_fixed.fam", 
-		shell=True
-		)	
-	fam_fix.communicate()
+def fam_fix(chrom):
+	run_command(os.path.join(dep_dir, "fam_fix.pl") + " model_" + str(chrom) + ".fam model_" + str(chrom) + "_fixed.fam")
 	print("FAM FIXED", flush = True) 
 
 	os.rename("model_" + str(chrom) + "_fixed.fam", "model_" + str(chrom) + ".fam")
@@ -700,21 +903,354 @@ def fam_fix():
 
 
 #Add SNP IDs to the VCF
-def bim_fix():
-	bim_fix = subprocess.Popen(
-			"../Dependencies/bim_fix.py ../Admixture/model_" + str(chrom) + " ../Admixture/model_" + str(chrom) + "_fixed.bim " + str(chrom),
-			shell=True
-			)
-	bim_fix.communicate()
-	os.system('mv ../Admixture/model_' + str(chrom) + '_fixed.bim ../Admixture/model_' + str(chrom) + '.bim')
+#Streams the .bim in-process, no separate interpreter needed
+def bim_fix(chrom):
+	fix_bim("model_" + str(chrom), "model_" + str(chrom) + "_fixed.bim", chrom)
+	os.rename("model_" + str(chrom) + "_fixed.bim", "model_" + str(chrom) + ".bim")
 	print("BIM FIXED", flush = True)
 
-def new_vcf():
-	new_vcf = subprocess.Popen(
-		"plink --bfile model_" + str(chrom) + " --recode vcf-iid --double-id --out snps_" + str(chrom), 
-		shell = True
-		)
-	new_vcf.communicate()
+#Independent ancestry and mutation seeds derived from one master seed
+#The chromosome is mixed in so chromosomes of the same run never share a random stream
+def derive_seeds(master_seed, chrom, num_replicates = 1):
+	states = np.random.SeedSequence([master_seed, int(chrom)]).generate_state(num_replicates + 1)
+	seeds = [int(state) % (2**32 - 1) + 1 for state in states]
+	return seeds[0], seeds[1:]
+
+def add_mutations(sim, mutation_seed, rate = mutation_rate):
+	import msprime
+	if backend == 'legacy':
+		model = msprime.InfiniteSites(msprime.NUCLEOTIDES)
+		return msprime.mutate(sim, rate = rate, model = model, random_seed = mutation_seed)
+	
+	if mutation_model == 'binary':
+		#two states written as nucleotides, since plink reads an allele of 0 as missing
+		model = msprime.MatrixMutationModel(alleles = ['A', 'T'], root_distribution = [1, 0], 
+			transition_matrix = [[0, 1], [1, 0]])
+	else:
+		model = msprime.JC69()
+	return msprime.sim_mutations(sim, rate = rate, model = model, random_seed = mutation_seed, 
+		discrete_genome = discrete_genome)
+
+#Put a simulated region back in its place on the chromosome, so positions in every output
+#are real chromosome coordinates (nothing is simulated outside the region)
+def place_region(sim, chrom):
+	start, end, _ = chrom_region(chrom)
+	chrom_length = chrom_params(chrom)[0]
+	if start == 0 and end == chrom_length:
+		return sim
+	return sim.shift(start, sequence_length = chrom_length)
+
+#The first n individuals of each population, simplified to their own ancestry
+#Samples are exchangeable, so this is a random subset, and smaller subsets are nested in larger ones
+#Sites the subset does not segregate for are dropped, as a simulation of the subset alone would not have them
+def subsample(sim, sizes):
+	nodes = np.concatenate([sim.samples(population = k)[:2 * n] for k, n in enumerate(sizes)])
+	sub = sim.simplify(samples = nodes, filter_populations = False)
+	fixed = [k for k, (_, counts) in enumerate(allele_freq.site_allele_counts(sub)) if max(counts) == sub.num_samples]
+	return sub.delete_sites(fixed)
+
+#Run the chosen model, or load its tree sequence from the cache when every input matches
+#Unseeded runs are never cached: their key would be the same every time, so each would get the first one's trees
+def simulate_chrom(chrom, pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, dem_option, sample_pop1, sample_pop2, sample_pop3, seed = None, cache_dir = None, cache_size = 50):
+	import msprime
+	import ts_cache
+	if seed is None:
+		ancestry_seed, mutation_seed = None, default_mutation_seed
+	else:
+		ancestry_seed, (mutation_seed,) = derive_seeds(seed, chrom)
+	if seed is None and cache_dir is not None:
+		print("NOT CACHED: NO --seed, CHROMOSOME", chrom, flush = True)
+		cache_dir = None
+	
+	if cache_dir is not None:
+		key_params = {
+			'pop1': pop1, 'pop2': pop2, 'pop3': pop3, 'time_admix': time_admix,
+			'prop_pop1': prop_pop1, 'prop_pop2': prop_pop2, 'chrom': str(chrom),
+			'dem_option': dem_option, 'sample_pop1': sample_pop1, 'sample_pop2': sample_pop2,
+			'sample_pop3': sample_pop3, 'ancestry_seed': ancestry_seed, 'mutation_seed': mutation_seed,
+			'msprime': msprime.__version__
+			}
+		if chrom_region(chrom)[:2] != (0, chrom_params(chrom)[0]):
+			key_params['region'] = list(chrom_region(chrom)[:2])
+		if backend != 'legacy':
+			key_params.update({'backend': backend, 'ancestry_model': ancestry_model, 
+				'discrete_genome': discrete_genome, 'mutation_model': mutation_model})
+		key = ts_cache.cache_key(key_params)
+		sim = ts_cache.load(cache_dir, key)
+		if sim is not None:
+			print("LOADED FROM CACHE:", key, "CHROMOSOME", chrom, flush = True)
+			return sim
+	
+	sim = models[dem_option](pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom, 
+	sample_pop1, sample_pop2, sample_pop3, random_seed = ancestry_seed)
+	sim = place_region(add_mutations(sim, mutation_seed), chrom)
+	print("SIMULATION COMPLETE", flush = True)
+	
+	if cache_dir is not None:
+		ts_cache.store(cache_dir, key, sim, int(cache_size * 1e9))
+		print("STORED IN CACHE:", key, flush = True)
+	return sim
+
+#Population info and a fixed plink fileset for one simulated chromosome, in the current directory
+#Rare sites are dropped from the tree sequence first when min_maf is set, so no writer sees them
+def write_chrom_files(sim, chrom, dem_option, sample_pop1, sample_pop2, sample_pop3, pop_info = True, plink_convert = False, min_maf = None):
+	#Create population information for the simulated data
+	if pop_info:
+		make_pop_info(sample_pop1, sample_pop2, sample_pop3)
+		print("POP INFO CREATED", flush = True)
+	
+	if min_maf:
+		sim = allele_freq.filter_sites(sim, min_maf)
+	
+	#allele counts for the freq stage, taken from the trees
+	allele_freq.write_acount(sim, "model_" + str(chrom), chrom)
+	#the tree sequence itself, for the diagnostics stage
+	sim.dump("model_" + str(chrom) + ".trees")
+	
+	if plink_convert:
+		make_plink_files(sim, chrom, double_id = (dem_option == 'collapse'))
+		fam_fix(chrom)
+		bim_fix(chrom)
+	else:
+		#sample and SNP IDs are written correctly from the start, no fixing needed
+		plink_io.write_plink(sim, "model_" + str(chrom), chrom)
+	print("FILES CREATED", flush = True)
+
+#Size of a simulated tree sequence, for run_report.json
+def sim_summary(sim, chrom):
+	return {'chrom': str(chrom), 'trees': sim.num_trees, 'edges': sim.num_edges, 'sites': sim.num_sites, 
+		'mutations': sim.num_mutations}
+
+#Simulate one chromosome and leave a fixed plink fileset behind
+#This is what each worker runs when several chromosomes are requested
+#keep_source also keeps the whole simulation (before any MAF filter) as source_<chrom>.trees for --subsample
+#and --mutation-replicates
+#Returns the size of the simulation and what it cost this process (and the commands it ran)
+def run_chrom(chrom, pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, dem_option, sample_pop1, sample_pop2, sample_pop3, pop_info = True, plink_convert = False, seed = None, cache_dir = None, cache_size = 50, min_maf = None, keep_source = False):
+	start = time.time()
+	cpu = sum(os.times()[:4])
+	sim = simulate_chrom(chrom, pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, dem_option, 
+	sample_pop1, sample_pop2, sample_pop3, seed = seed, cache_dir = cache_dir, cache_size = cache_size)
+	if keep_source:
+		sim.dump("source_" + str(chrom) + ".trees")
+	write_chrom_files(sim, chrom, dem_option, sample_pop1, sample_pop2, sample_pop3, 
+	pop_info = pop_info, plink_convert = plink_convert, min_maf = min_maf)
+	
+	stats = sim_summary(sim, chrom)
+	stats.update({'wall_time': time.time() - start, 'cpu_time': sum(os.times()[:4]) - cpu, 
+		'peak_rss': 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 
+		resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)})
+	return stats
+
+#Replicates come one at a time from msprime's num_replicates generator, so only one is held in memory
+#Each is mutated with its own seed and run through the whole pipeline in rep_<n>/
+def run_replicates(chrom, pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, dem_option, sample_pop1, sample_pop2, sample_pop3, num_replicates, seed = None, plink_convert = False, min_maf = None, stage_options = {}):
+	if seed is None:
+		seed = int(np.random.SeedSequence().entropy % (2**63))
+	print("MASTER SEED:", seed, flush = True)
+	
+	ancestry_seed, mutation_seeds = derive_seeds(seed, chrom, num_replicates)
+	reps = iter(models[dem_option](pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom, 
+	sample_pop1, sample_pop2, sample_pop3, random_seed = ancestry_seed, num_replicates = num_replicates))
+	
+	for i in range(num_replicates):
+		rep_dir = "rep_" + str(i + 1)
+		os.makedirs(rep_dir, exist_ok = True)
+		os.chdir(rep_dir)
+		
+		#the next replicate's ancestry is simulated when it is taken from the generator
+		def simulate_replicate():
+			sim = place_region(add_mutations(next(reps), mutation_seeds[i]), chrom)
+			print("SIMULATION COMPLETE: REPLICATE", i + 1, "ANCESTRY SEED", ancestry_seed, 
+			"MUTATION SEED", mutation_seeds[i], flush = True)
+			run_report.add_simulation(sim_summary(sim, chrom))
+			write_chrom_files(sim, chrom, dem_option, sample_pop1, sample_pop2, sample_pop3, 
+			plink_convert = plink_convert, min_maf = min_maf)
+		
+		run_report.measure('simulate', chrom, simulate_replicate)
+		run_graph(stage_graph(), chrom, **stage_options)
+		os.chdir("..")
+
+#Datasets derived from the simulation the main run kept (source_<chrom>.trees), each run through the
+#whole pipeline in its own directory; datasets is a list of (directory, sample sizes, derive(sim, chrom))
+#Deriving a dataset takes seconds where simulating again would take as long as the main run
+def run_derived(chrom_list, label, datasets, dem_option, plink_convert = False, min_maf = None, stage_options = {}):
+	import tskit
+	sources = ['../source_' + str(chrom) + '.trees' for chrom in chrom_list]
+	for data_dir, sizes, derive in datasets:
+		os.makedirs(data_dir, exist_ok = True)
+		os.chdir(data_dir)
+		print("DERIVED DATASET:", data_dir, flush = True)
+		
+		def simulate_derived(chrom):
+			make_pop_info(*sizes)
+			for source, source_chrom in zip(sources, chrom_list):
+				sim = derive(tskit.load(source), source_chrom)
+				run_report.add_simulation(sim_summary(sim, source_chrom))
+				write_chrom_files(sim, source_chrom, dem_option, *sizes, pop_info = False, 
+				plink_convert = plink_convert, min_maf = min_maf)
+			if len(chrom_list) > 1:
+				merge_chroms(chrom_list, chrom)
+		
+		#the dataset is redone whenever the simulation it comes from changes
+		graph = stage_graph(simulate_derived)
+		graph[0]['inputs'] = sources
+		run_graph(graph, label, **stage_options)
+		os.chdir("..")
+
+#--subsample: smaller sample configurations, each in subsample_<n1>_<n2>_<n3>/
+def subsample_datasets(subsamples):
+	return [("subsample_" + "_".join(str(n) for n in sizes), sizes, 
+		lambda sim, chrom, sizes = sizes: subsample(sim, sizes)) for sizes in subsamples]
+
+#The ancestry of sim with new mutations: replicate k of the master seed, at the given rate
+def remutate(sim, chrom, rate, k, master_seed):
+	tables = sim.dump_tables()
+	tables.sites.clear()
+	tables.mutations.clear()
+	mutation_seed = derive_seeds(master_seed, chrom, k + 1)[1][k]
+	print("MUTATION REPLICATE", k, "CHROMOSOME", chrom, "RATE", rate, "MUTATION SEED", mutation_seed, flush = True)
+	return add_mutations(tables.tree_sequence(), mutation_seed, rate)
+
+#--mutation-replicates: the same ancestry with K new sets of mutations, each in mutrep_<k>/, or over a
+#grid of mutation rates in mutrep_<rate>_<k>/. Replicate k uses the same seed at every rate, and
+#the first derived seed (the main run's, with --seed) is never used, so every replicate is a new draw
+def mutation_datasets(rates, num_replicates, master_seed, sizes, rate_grid = False):
+	return [("mutrep_" + (str(rate) + "_" if rate_grid else "") + str(k), sizes, 
+		lambda sim, chrom, rate = rate, k = k: remutate(sim, chrom, rate, k, master_seed)) 
+		for rate in rates for k in range(1, num_replicates + 1)]
+
+#One calibration region, run in its own worker process so its peak memory can be read off
+def calibration_run(spec, length, seed):
+	baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+	start = time.time()
+	sim = simulate_demography(**dict(spec, length = length, random_seed = seed, num_replicates = None))
+	sim = add_mutations(sim, seed)
+	return {'length': length, 'wall_time': time.time() - start, 'trees': sim.num_trees, 
+		'edges': sim.num_edges, 'sites': sim.num_sites, 'mutations': sim.num_mutations, 
+		'trees_bytes': sim.nbytes, 'baseline_rss': baseline, 
+		'rss_increase': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline}
+
+#Demography check and cost predictions for one chromosome, from short regions of it
+def estimate_chrom(chrom, pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, dem_option, sample_pop1, sample_pop2, sample_pop3, seed = None):
+	import msprime
+	#the model's populations and events, without simulating anything
+	spec = models[dem_option](pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom, 
+	sample_pop1, sample_pop2, sample_pop3, simulator = lambda **kwargs: kwargs)
+	length = spec['length']
+	
+	demography = msprime.Demography.from_old_style(spec['population_configurations'], 
+		migration_matrix = spec['migration_matrix'], demographic_events = spec['demographic_events'], 
+		ignore_sample_size = True)
+	report = {'chrom': str(chrom), 'length': length, 
+		'demography': estimate.demography_report(demography, "estimate_history_" + str(chrom) + ".txt")}
+	
+	calibration_seed = derive_seeds(1 if seed is None else seed, chrom)[0]
+	calibration = []
+	fraction = estimate.first_fraction
+	while True:
+		with multiprocessing.get_context("fork").Pool(1) as pool:
+			run = pool.apply(calibration_run, (spec, int(length * fraction), calibration_seed))
+		print("CALIBRATION:", run['length'], "BP", round(run['wall_time'], 1), "S", flush = True)
+		calibration.append(run)
+		fraction *= 2
+		if len(calibration) >= 3 and (run['wall_time'] >= estimate.min_calibration_time or fraction > estimate.max_fraction):
+			break
+	report['calibration'] = calibration
+	
+	calibration = calibration[-3:]
+	lengths = [run['length'] for run in calibration]
+	predicted = {name: estimate.extrapolate_linear(lengths, [run[name] for run in calibration], length) 
+		for name in ('trees', 'edges', 'sites', 'mutations', 'trees_bytes')}
+	predicted['wall_time'] = estimate.extrapolate_power(lengths, [run['wall_time'] for run in calibration], length)
+	predicted['peak_rss'] = calibration[-1]['baseline_rss'] + estimate.extrapolate_linear(lengths, 
+		[run['rss_increase'] for run in calibration], length)
+	predicted['files'] = estimate.output_sizes(predicted['sites'], sample_pop1 + sample_pop2 + sample_pop3, chrom, length)
+	report['predicted'] = predicted
+	
+	for warning in report['demography']['warnings']:
+		print("WARNING:", warning, flush = True)
+	print("ESTIMATE CHROMOSOME", chrom, ":", int(predicted['trees']), "TREES,", int(predicted['sites']), "SITES,", 
+	"SIMULATION", round(predicted['wall_time']), "S,", "PEAK RSS", round(predicted['peak_rss'] / 1e9, 2), "GB,", 
+	".bed", round(predicted['files']['bed'] / 1e6, 1), "MB,", "VCF (uncompressed)", round(predicted['files']['vcf'] / 1e6, 1), "MB", flush = True)
+	return report
+
+#Estimates for every chromosome, and for the run as a whole, in estimate_<label>.json
+#Chromosomes are simulated by min(workers, chromosomes) processes at once, replicates one after another
+def estimate_run(chrom_list, label, pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, dem_option, sample_pop1, sample_pop2, sample_pop3, workers = 1, seed = None, replicates = None):
+	reports = [estimate_chrom(chrom, pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, dem_option, 
+	sample_pop1, sample_pop2, sample_pop3, seed = seed) for chrom in chrom_list]
+	n_workers = min(workers, len(chrom_list))
+	n_runs = replicates or 1
+	total = {
+		'wall_time': n_runs * sum(r['predicted']['wall_time'] for r in reports) / n_workers,
+		'peak_rss': n_workers * max(r['predicted']['peak_rss'] for r in reports),
+		'files': {name: n_runs * sum(r['predicted']['files'][name] for r in reports) 
+			for name in reports[0]['predicted']['files']},
+		'warnings': sorted(set(w for r in reports for w in r['demography']['warnings']))
+		}
+	with open("estimate_" + str(label) + ".json", "w") as file:
+		json.dump({'chromosomes': reports, 'total': total}, file, indent = 1)
+	print("ESTIMATED SIMULATION TIME", round(total['wall_time']), "S, PEAK RSS", round(total['peak_rss'] / 1e9, 2), 
+	"GB, WRITTEN TO estimate_" + str(label) + ".json", flush = True)
+	return total
+
+#Join per-chromosome filesets into one
+#All chromosomes share the same samples, so the SNP-major .bed records can be
+#concatenated directly; SNP IDs are prefixed with the chromosome to keep them unique
+def merge_chroms(chrom_list, label):
+	import tskit
+	bed_magic = bytes([0x6c, 0x1b, 0x01])
+	
+	with open("model_" + str(chrom_list[0]) + ".fam", "r") as file:
+		famdata = file.read()
+	with open("model_" + str(label) + ".fam", "w") as file:
+		file.write(famdata)
+	
+	with open("model_" + str(label) + ".bed", "wb") as bed, open("model_" + str(label) + ".bim", "w") as bim:
+		bed.write(bed_magic)
+		for chrom in chrom_list:
+			with open("model_" + str(chrom) + ".fam", "r") as file:
+				if file.read() != famdata:
+					sys.exit("Samples in model_" + str(chrom) + ".fam do not match, cannot merge")
+			with open("model_" + str(chrom) + ".bed", "rb") as file:
+				if file.read(3) != bed_magic:
+					sys.exit("model_" + str(chrom) + ".bed is not a SNP-major plink file")
+				shutil.copyfileobj(file, bed)
+			with open("model_" + str(chrom) + ".bim", "r") as file:
+				for line in file:
+					fields = line.split()
+					fields[1] = str(chrom) + "_" + fields[1]
+					bim.write("\t".join(fields) + "\n")
+	
+	with open("model_" + str(label) + ".acount", "w") as acount:
+		acount.write(allele_freq.acount_header)
+		for chrom in chrom_list:
+			with open("model_" + str(chrom) + ".acount", "r") as file:
+				for line in file:
+					if line.startswith("#"):
+						continue
+					fields = line.split()
+					fields[1] = str(chrom) + "_" + fields[1]
+					acount.write("\t".join(fields) + "\n")
+	
+	#every chromosome has the same sample nodes, so the tree sequences join end to end
+	#(trimmed, so the unsimulated parts of region runs don't count towards the statistics)
+	merged = tskit.load("model_" + str(chrom_list[0]) + ".trees").trim()
+	for chrom in chrom_list[1:]:
+		merged = merged.concatenate(tskit.load("model_" + str(chrom) + ".trees").trim())
+	merged.dump("model_" + str(label) + ".trees")
+	
+	print("CHROMOSOMES MERGED:", str(label), flush = True)
+
+#BGZF-compressed VCF with a tabix index, so regions can be pulled out without decompressing the whole file
+def new_vcf(chrom):
+	if vcf_engine == 'plink':
+		plink("--bfile model_" + str(chrom) + " --recode vcf-iid bgz --double-id --out snps_" + str(chrom))
+		bgzf.index_vcf("snps_" + str(chrom) + ".vcf.gz")
+	else:
+		#genotypes are decoded from the .bed block by block, compressed and indexed in the same pass
+		vcf_io.write_vcf_from_bed("model_" + str(chrom), "snps_" + str(chrom) + ".vcf.gz", vcf_level)
 	print("NEW VCF CREATED", flush = True) 
 
 #def snp_id():
@@ -726,12 +1262,12 @@ def new_vcf():
 #Finally ready for plink	
 #Perform pca and plot
 
-def pca_test():
-	pca = subprocess.Popen(
-		"plink --bfile model_" + str(chrom) + " --pca --out model_" + str(chrom) + "_pca", 
-		shell=True
-		)
-	pca.communicate()
+def pca_test(chrom):
+	if pca_engine == 'plink':
+		plink("--bfile model_" + str(chrom) + " --pca --out model_" + str(chrom) + "_pca")
+	else:
+		#reads the .bed in blocks, writes the same .eigenvec/.eigenval files as plink
+		pca.write_pca("model_" + str(chrom), "model_" + str(chrom) + "_pca")
 	
 	#plot = subprocess.Popen(
 	#	"Rscript ../Dependencies/pca_plot.R", 
@@ -741,48 +1277,61 @@ def pca_test():
 	print("PCA FINISHED", flush = True)
 
 #Prune the dataset
-def prune():	
-	prune = subprocess.Popen(
-		"plink --bfile model_" + str(chrom) + " --indep-pairwise 50 2 0.8 --double-id --out " + str(chrom),
-		shell=True
-		)
-	prune.communicate()
+def prune(chrom):	
+	if prune_engine == 'plink':
+		plink("--bfile model_" + str(chrom) + " --indep-pairwise 50 2 0.8 --double-id --out " + str(chrom))
+	else:
+		#plink's windows and pruning rule, prune.in/prune.out lists in plink's layout
+		ld_prune.write_prune_lists("model_" + str(chrom), str(chrom), 50, 2, 0.8)
 
 #New dataset for pruned beds
-def make_beds():
-	new_bed = subprocess.Popen(
-		"plink --bfile model_" + str(chrom) + " --extract " + str(chrom) + ".prune.in --make-bed --double-id --out pruned_model_" + str(chrom), 
-		shell=True
-		)
-	new_bed.communicate()
-	
-	new_bedout = subprocess.Popen(
-		"plink --bfile model_" + str(chrom) + " --extract " + str(chrom) + ".prune.out --make-bed --double-id --out outpruned_model_" + str(chrom), 
-		shell=True
-		)
-	new_bedout.communicate()
-
-def prune_mp():
-	m_p = subprocess.Popen(
-		"plink --bfile pruned_model_" + str(chrom) + " --recode --double-id --out pruned_model_" + str(chrom), 
-		shell=True
-		)
-	m_p.communicate()
+#The pruned and out-pruned sets don't depend on each other, so they are extracted side by side
+def make_beds(chrom):
+	if prune_engine == 'numpy':
+		#copy the packed .bed records straight across instead of two plink passes
+		with open(str(chrom) + ".prune.in", "r") as file:
+			keep_ids = set(file.read().split())
+		_, snp_ids = ld_prune.read_bim_ids("model_" + str(chrom))
+		keep = [snp in keep_ids for snp in snp_ids]
+		plink_io.write_bed_subset("model_" + str(chrom), "pruned_model_" + str(chrom), keep)
+		plink_io.write_bed_subset("model_" + str(chrom), "outpruned_model_" + str(chrom), [not k for k in keep])
+		return
+	
+	with concurrent.futures.ThreadPoolExecutor(2) as pool:
+		new_bed = pool.submit(run_report.inherit(plink), "--bfile model_" + str(chrom) + " --extract " + str(chrom) + 
+			".prune.in --make-bed --double-id --out pruned_model_" + str(chrom))
+		new_bedout = pool.submit(run_report.inherit(plink), "--bfile model_" + str(chrom) + " --extract " + str(chrom) + 
+			".prune.out --make-bed --double-id --out outpruned_model_" + str(chrom))
+		new_bed.result()
+		new_bedout.result()
+
+def prune_mp(chrom):
+	plink("--bfile pruned_model_" + str(chrom) + " --recode --double-id --out pruned_model_" + str(chrom))
 	
 #run ADMIXTURE
-def admixture_test():
-	admix = subprocess.Popen(
-		"for K in 1 2 3; \
-		do admixture --cv pruned_model_" + str(chrom) + ".bed $K | tee log${K}_" + str(chrom) + ".out; done", 
-		shell=True
-		)
-	admix.communicate()
-	
-	cv_grab = subprocess.Popen(
-		"grep -h CV log*_" + str(chrom) + ".out > cv_error_" + str(chrom) + ".txt",
-		shell = True
-		)
-	cv_grab.communicate()
+#With the admixture binary, K = 1, 2 and 3 are independent runs, so they go side by side
+#The numpy engine writes the same .Q/.P files, logs and CV error lines itself; it reads the genotypes
+#once and fits one K at a time, each with --plink-threads threads, so each K's convergence time is its own
+def admixture_test(chrom):
+	if admixture_engine == 'numpy':
+		geno = ancestry.read_genotypes("pruned_model_" + str(chrom))
+		with open("cv_error_" + str(chrom) + ".txt", "w") as cv_error:
+			for K in (1, 2, 3):
+				result = ancestry.run_admixture("pruned_model_" + str(chrom), K, threads = plink_threads, geno = geno)
+				cv_line = "CV error (K=" + str(K) + "): " + str(round(result['cv_error'], 5))
+				with open("log" + str(K) + "_" + str(chrom) + ".out", "w") as log:
+					log.write("Loglikelihood: " + str(round(result['loglikelihood'], 6)) + "\n" + 
+					"Converged in " + str(result['iterations']) + " iterations (" + str(round(result['time'], 3)) + " sec)\n" + 
+					"Cross-validation: " + str(ancestry.cv_folds) + " folds (" + str(round(result['cv_time'], 3)) + " sec)\n" + 
+					cv_line + "\n")
+				cv_error.write(cv_line + "\n")
+				print("ADMIXTURE K =", K, "CONVERGED IN", result['iterations'], "ITERATIONS,", round(result['time'], 2), "S, CV", 
+				round(result['cv_time'], 2), "S, CV ERROR", round(result['cv_error'], 5), flush = True)
+	else:
+		run_parallel(["admixture --cv -j" + str(plink_threads) + " pruned_model_" + str(chrom) + ".bed " + str(K) + 
+			" | tee log" + str(K) + "_" + str(chrom) + ".out" for K in (1, 2, 3)])
+		
+		run_command("grep -h CV log*_" + str(chrom) + ".out > cv_error_" + str(chrom) + ".txt")
 	
 	#cv_error = subprocess.Popen(
 	#	"Rscript ../Dependencies/cv_error_plot.R",
@@ -798,23 +1347,219 @@ def admixture_test():
 	
 	print("ADMIXTURE FINISHED", flush = True)
 
+#f-statistics, D and Fst between PAR1, PAR2 and ADM straight from the tree sequence
+#With --max-alpha-error, a run whose admixture proportion came out wrong stops here, before ADMIXTURE
+def diagnostics(chrom):
+	import tskit
+	import fstats
+	#statistics are per bp of what was simulated, so a region run's empty flanks are trimmed off
+	results = fstats.write_diagnostics(tskit.load("model_" + str(chrom) + ".trees").trim(), "diagnostics_" + str(chrom) + ".json")
+	alpha_branch = results['branch']['alpha_pop1']
+	alpha_site = results['site']['alpha_pop1']
+	print("POP1 ADMIXTURE PROPORTION: BRANCH", round(alpha_branch, 4), "SITE", round(alpha_site, 4), 
+	"SIMULATED", prop_pop1, flush = True)
+	
+	if max_alpha_error is not None and abs(alpha_site - prop_pop1) > max_alpha_error:
+		sys.exit("Estimated pop1 admixture proportion " + str(round(alpha_site, 4)) + " is more than " + 
+		str(max_alpha_error) + " from " + str(prop_pop1))
+
 #MAF removal
-def freq():
-	freq = subprocess.Popen(
-		"plink --bfile model_" + str(chrom) + " --maf 0.05 --double-id --make-bed --out sims_" + str(chrom),
-		shell=True
-		)
-	freq.communicate()
-
-def main(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom, dem_option, sample_pop1, sample_pop2, sample_pop3):
-	if (len(sys.argv) >= 13):
-		print("Too many arguments specified", flush = True)
-		exit()
-	elif (len(sys.argv) < 12):
-		print("Too few arguments specified", flush = True)
-		exit()
+def freq(chrom):
+	if freq_engine == 'plink':
+		plink("--bfile model_" + str(chrom) + " --maf 0.05 --double-id --make-bed --out sims_" + str(chrom))
+	else:
+		#the allele counts came from the trees, so only the kept .bed records are copied
+		keep = allele_freq.maf_mask("model_" + str(chrom), 0.05)
+		plink_io.write_bed_subset("model_" + str(chrom), "sims_" + str(chrom), keep)
+
+#Genotype matrix for NumPy analyses, straight from the trees (the sites and order of the .bim)
+def export(chrom):
+	import tskit
+	import geno_export
+	ts = tskit.load("model_" + str(chrom) + ".trees")
+	if export_format == 'zarr':
+		n_sites = geno_export.write_zarr(ts, "model_" + str(chrom), "genotypes_" + str(chrom) + ".zarr", export_packed)
 	else:
-		pass
+		n_sites = geno_export.write_npy(ts, "model_" + str(chrom), "genotypes_" + str(chrom), export_packed)
+	print("GENOTYPES EXPORTED:", n_sites, "SITES", flush = True)
+
+#Options that change what a stage writes, by stage. run_graph keeps them in .stages/<stage>_options_<chrom>.json,
+#one of the stage's inputs, rewritten only when they change, so changing one reruns the stage and what follows
+def stage_options():
+	return {
+		'vcf': {'vcf_engine': vcf_engine, 'vcf_level': vcf_level},
+		'pca': {'pca_engine': pca_engine},
+		'prune': {'prune_engine': prune_engine},
+		'make_beds': {'prune_engine': prune_engine},
+		'admixture': {'admixture_engine': admixture_engine},
+		'freq': {'freq_engine': freq_engine},
+		'export': {'export': export_format, 'export_packed': export_packed}
+		}
+
+def options_path(name):
+	return os.path.join(".stages", name + "_options_{c}.json")
+
+#The pipeline as a dependency graph: each stage lists the files it reads and writes
+#({c} is the chromosome label). Stages are listed in an order that respects their dependencies.
+#simulate is left out when the fileset already exists (replicates), export unless --export is given
+def stage_graph(simulate = None):
+	plink_set = ['model_{c}.bed', 'model_{c}.bim', 'model_{c}.fam']
+	pruned_set = ['pruned_model_{c}.bed', 'pruned_model_{c}.bim', 'pruned_model_{c}.fam']
+	graph = [
+		{'name': 'diagnostics', 'run': diagnostics, 'inputs': ['model_{c}.trees'], 'outputs': ['diagnostics_{c}.json']},
+		{'name': 'vcf', 'run': new_vcf, 'inputs': plink_set, 'outputs': ['snps_{c}.vcf.gz', 'snps_{c}.vcf.gz.tbi']},
+		{'name': 'pca', 'run': pca_test, 'inputs': plink_set, 
+			'outputs': ['model_{c}_pca.eigenvec', 'model_{c}_pca.eigenval']},
+		{'name': 'prune', 'run': prune, 'inputs': plink_set, 
+			'outputs': ['{c}.prune.in', '{c}.prune.out']},
+		{'name': 'make_beds', 'run': make_beds, 'inputs': plink_set + ['{c}.prune.in', '{c}.prune.out'], 
+			'outputs': pruned_set + ['outpruned_model_{c}.bed', 'outpruned_model_{c}.bim', 'outpruned_model_{c}.fam']},
+		{'name': 'prune_mp', 'run': prune_mp, 'inputs': pruned_set, 
+			'outputs': ['pruned_model_{c}.ped', 'pruned_model_{c}.map']},
+		{'name': 'admixture', 'run': admixture_test, 'inputs': pruned_set + ['diagnostics_{c}.json'], 
+			'outputs': ['pruned_model_{c}.' + str(K) + '.' + ext for K in (1, 2, 3) for ext in ('Q', 'P')] + 
+			['cv_error_{c}.txt']},
+		{'name': 'freq', 'run': freq, 'inputs': plink_set + ['model_{c}.acount'], 'outputs': ['sims_{c}.bed', 'sims_{c}.bim', 'sims_{c}.fam']}
+		]
+	if export_format == 'zarr':
+		graph.append({'name': 'export', 'run': export, 'inputs': ['model_{c}.trees', 'model_{c}.bim'], 
+			'outputs': ['genotypes_{c}.zarr']})
+	elif export_format == 'npy':
+		graph.append({'name': 'export', 'run': export, 'inputs': ['model_{c}.trees', 'model_{c}.bim'], 
+			'outputs': ['genotypes_{c}.npy'] + ['genotypes_{c}_' + name + '.npy' for name in ('chroms', 'positions', 'alleles', 'samples', 'populations')]})
+	if simulate is not None:
+		graph.insert(0, {'name': 'simulate', 'run': simulate, 'inputs': ['run_params_{c}.json'], 
+			'outputs': plink_set + ['model_{c}.acount', 'model_{c}.trees', 'population_information.txt']})
+	options = stage_options()
+	for stage in graph:
+		if stage['name'] in options:
+			stage['options'] = options[stage['name']]
+			stage['inputs'] = stage['inputs'] + [options_path(stage['name'])]
+	return graph
+
+#The named stage plus every stage that reads (directly or not) something it writes
+def downstream(graph, name):
+	selected = set([name])
+	produced = set()
+	for stage in graph:
+		if stage['name'] in selected or produced.intersection(stage['inputs']):
+			selected.add(stage['name'])
+			produced.update(stage['outputs'])
+	return selected
+
+def file_hash(path):
+	digest = hashlib.sha256()
+	with open(path, "rb") as file:
+		for chunk in iter(lambda: file.read(1 << 20), b""):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+def stamp_path(name, chrom):
+	return os.path.join(".stages", name + "_" + str(chrom) + ".json")
+
+def up_to_date(name, chrom, inputs, outputs, check):
+	if not all(os.path.exists(f) for f in outputs):
+		return False
+	if check == 'hash':
+		if not os.path.exists(stamp_path(name, chrom)):
+			return False
+		with open(stamp_path(name, chrom), "r") as file:
+			stamp = json.load(file)
+		return stamp == {f: file_hash(f) for f in inputs}
+	return min(os.path.getmtime(f) for f in outputs) >= max(os.path.getmtime(f) for f in inputs)
+
+#Check, run and verify one stage; returns False if it was skipped as up to date
+def run_stage(stage, chrom, forced, check):
+	name = stage['name']
+	inputs = [f.format(c = chrom) for f in stage['inputs']]
+	outputs = [f.format(c = chrom) for f in stage['outputs']]
+	
+	missing = [f for f in inputs if not os.path.exists(f)]
+	if missing:
+		sys.exit("Cannot run stage " + name + ", missing " + ", ".join(missing))
+	if not forced and up_to_date(name, chrom, inputs, outputs, check):
+		print("SKIPPING " + name.upper() + " (UP TO DATE)", flush = True)
+		run_report.skipped(name, chrom)
+		return False
+	
+	print("RUNNING " + name.upper(), flush = True)
+	run_report.measure(name, chrom, lambda: stage['run'](chrom))
+	
+	missing = [f for f in outputs if not os.path.exists(f)]
+	if missing:
+		sys.exit("Stage " + name + " did not produce " + ", ".join(missing))
+	os.makedirs(".stages", exist_ok = True)
+	with open(stamp_path(name, chrom), "w") as file:
+		json.dump({f: file_hash(f) for f in inputs} if check == 'hash' else {}, file)
+	return True
+
+#Run stages whose outputs are missing or out of date, like make
+#run_from reruns a stage and everything downstream of it, only reruns just the listed stages
+#Up to jobs stages run at once; a stage starts as soon as every selected stage writing one of its inputs is done
+#If a stage fails, stages already running are allowed to finish but nothing new is started
+#What every stage cost is written to run_report.json at the end, whether or not the run succeeded
+def run_graph(graph, chrom, run_from = None, only = None, force = False, check = 'mtime', jobs = 1):
+	started = time.time()
+	cpu_started = run_report.process_cpu_time()
+	names = [stage['name'] for stage in graph]
+	if only:
+		selected = set(only)
+	elif run_from:
+		selected = downstream(graph, run_from)
+	else:
+		selected = set(names)
+	forced = selected if (force or only or run_from) else set()
+	stages = [stage for stage in graph if stage['name'] in selected]
+	
+	os.makedirs(".stages", exist_ok = True)
+	for stage in graph:
+		if 'options' in stage:
+			write_params(options_path(stage['name']).format(c = chrom), stage['options'])
+	
+	needs = {}
+	for stage in stages:
+		inputs = set(f.format(c = chrom) for f in stage['inputs'])
+		needs[stage['name']] = set(other['name'] for other in stages 
+			if inputs.intersection(f.format(c = chrom) for f in other['outputs']))
+	
+	done = set()
+	running = {}
+	failure = None
+	with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+		while True:
+			if failure is None:
+				for stage in stages:
+					name = stage['name']
+					if name not in done and name not in running.values() and needs[name] <= done:
+						running[pool.submit(run_stage, stage, chrom, name in forced, check)] = name
+			if not running:
+				break
+			finished, _ = concurrent.futures.wait(running, return_when = concurrent.futures.FIRST_COMPLETED)
+			for future in finished:
+				done.add(running.pop(future))
+				if future.exception() is not None and failure is None:
+					failure = future.exception()
+	
+	report = run_report.write("run_report.json", started, cpu_started)
+	print("RUN REPORT WRITTEN: WALL TIME", round(report['wall_time'], 1), "S, CPU TIME", 
+	round(report['cpu_time'], 1), "S, PEAK RSS", round(report['peak_rss'] / 1e9, 2), "GB", flush = True)
+	if failure is not None:
+		raise failure
+
+#Parameters of the simulate stage, rewritten only when they change so its mtime tracks them
+def write_run_params(chrom, params):
+	write_params("run_params_" + str(chrom) + ".json", params)
+
+def write_params(path, params):
+	text = json.dumps(params, sort_keys = True, indent = 1)
+	if os.path.exists(path):
+		with open(path, "r") as file:
+			if file.read() == text:
+				return
+	with open(path, "w") as file:
+		file.write(text)
+
+def main(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom_list, dem_option, sample_pop1, sample_pop2, sample_pop3, workers = 1, plink_convert = False, cache_dir = None, cache_size = 50, seed = None, replicates = None, run_from = None, only = None, force = False, check = 'mtime', jobs = 1, min_maf = None):
 		
 	#for file in os.listdir("."):
 	#	if file.endswith(".pdf"):
@@ -823,29 +1568,104 @@ def main(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom, dem_option,
 	#	else:
 	#		pass 
 
-	if sys.argv[8] == 'constant':
-		model_admix_constant(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom, 
-		sample_pop1, sample_pop2, sample_pop3)
-	elif sys.argv[8] == 'collapse':
-		model_admix_collapse(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom, 
-		sample_pop1, sample_pop2, sample_pop3)
-	elif sys.argv[8] == 'expansion':
-		model_admix_expansion(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom, 
-		sample_pop1, sample_pop2, sample_pop3)
-	else:
-		sys.exit('Did you specify constant, collapse, or expansion models?', flush = True)
-		
-	fam_fix()
-	bim_fix()
-	new_vcf()
-	#snp_id()
-	pca_test()
-	prune()
-	make_beds()
-	prune_mp()
-	admixture_test()
-	freq()
+	if estimate_only:
+		estimate_run(chrom_list, chrom_list[0] if len(chrom_list) == 1 else "merged", pop1, pop2, pop3, 
+		time_admix, prop_pop1, prop_pop2, dem_option, sample_pop1, sample_pop2, sample_pop3, 
+		workers = workers, seed = seed, replicates = replicates)
+		return
+	
+	if replicates is not None:
+		if len(chrom_list) > 1:
+			sys.exit("--replicates runs one chromosome at a time")
+		run_replicates(chrom_list[0], pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, dem_option, 
+		sample_pop1, sample_pop2, sample_pop3, replicates, seed = seed, plink_convert = plink_convert, 
+		min_maf = min_maf, stage_options = {'only': only, 'force': force, 'check': check, 'jobs': jobs, 
+			'run_from': None if run_from == 'simulate' else run_from})
+		return
+
+	chrom_job = functools.partial(run_chrom, pop1 = pop1, pop2 = pop2, pop3 = pop3, 
+		time_admix = time_admix, prop_pop1 = prop_pop1, prop_pop2 = prop_pop2, dem_option = dem_option, 
+		sample_pop1 = sample_pop1, sample_pop2 = sample_pop2, sample_pop3 = sample_pop3, 
+		plink_convert = plink_convert, seed = seed, cache_dir = cache_dir, cache_size = cache_size, 
+		min_maf = min_maf, keep_source = bool(subsamples or mutation_replicates))
+
+	def simulate(chrom):
+		if len(chrom_list) == 1:
+			#ran in this thread, so its cost is already counted by the stage
+			stats = chrom_job(chrom)
+			run_report.add_simulation({name: stats[name] for name in ('chrom', 'trees', 'edges', 'sites', 'mutations')})
+		else:
+			#population info is the same for every chromosome, write it once up front
+			make_pop_info(sample_pop1, sample_pop2, sample_pop3)
+			
+			#fork keeps the parsed arguments and working directory in the workers
+			with multiprocessing.get_context("fork").Pool(min(workers, len(chrom_list))) as pool:
+				for stats in pool.map(functools.partial(chrom_job, pop_info = False), chrom_list):
+					run_report.add_simulation(stats)
+			
+			merge_chroms(chrom_list, chrom)
+
+	chrom = chrom_list[0] if len(chrom_list) == 1 else "merged"
+	write_run_params(chrom, {
+		'pop1': pop1, 'pop2': pop2, 'pop3': pop3, 'time_admix': time_admix, 
+		'prop_pop1': prop_pop1, 'prop_pop2': prop_pop2, 'chroms': chrom_list, 
+		'dem_option': dem_option, 'sample_pop1': sample_pop1, 'sample_pop2': sample_pop2, 
+		'sample_pop3': sample_pop3, 'seed': seed, 'plink_convert': plink_convert, 'maf': min_maf, 
+		'backend': backend, 'ancestry_model': ancestry_model, 'discrete_genome': discrete_genome, 
+		'mutation_model': mutation_model, 'start': region_start, 'end': region_end, 'length': region_length, 
+		'scale': region_scale
+		})
+	graph = stage_graph(simulate)
+	if subsamples or mutation_replicates:
+		graph[0]['outputs'] = graph[0]['outputs'] + ['source_' + str(c) + '.trees' for c in chrom_list]
+	run_graph(graph, chrom, run_from = run_from, only = only, force = force, check = check, jobs = jobs)
+	
+	datasets = subsample_datasets(subsamples)
+	if mutation_replicates:
+		mutation_seed = seed
+		if mutation_seed is None:
+			mutation_seed = int(np.random.SeedSequence().entropy % (2**63))
+			print("MUTATION MASTER SEED:", mutation_seed, flush = True)
+		datasets += mutation_datasets(mutation_rates or [mutation_rate], mutation_replicates, mutation_seed, 
+		(sample_pop1, sample_pop2, sample_pop3), rate_grid = mutation_rates is not None)
+	if datasets:
+		run_derived(chrom_list, chrom, datasets, dem_option, plink_convert = plink_convert, min_maf = min_maf, 
+		stage_options = {'only': only, 'force': force, 'check': check, 'jobs': jobs, 'run_from': run_from})
+
+
+#Library use: the simulated (and mutated) tree sequence for params (see configure), loaded from
+#--cache-dir when it is there, before any --maf filter. Nothing is written; one chromosome only
+def simulate(params):
+	configure(params)
+	if len(chrom_list) > 1:
+		raise ValueError("simulate takes one chromosome, call it once for each")
+	return simulate_chrom(chrom_list[0], pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, dem_option, 
+	sample_pop1, sample_pop2, sample_pop3, seed = seed, cache_dir = cache_dir, cache_size = cache_size)
+
+#Library use: the whole pipeline (or --estimate) for params in outdir, as the command line runs it in Admixture/
+#The working directory is changed for the run and restored afterwards, so runs in one process go one at a time
+#A failing stage exits with SystemExit, as on the command line
+def run_pipeline(params, outdir = "Admixture"):
+	configure(params)
+	cwd = os.getcwd()
+	os.makedirs(outdir, exist_ok = True)
+	os.chdir(outdir)
+	try:
+		main(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom_list, dem_option, sample_pop1, sample_pop2, sample_pop3, 
+		workers, plink_convert, cache_dir, cache_size, seed, replicates, run_from, only, force, check, jobs, min_maf)
+	finally:
+		os.chdir(cwd)
+	return os.path.abspath(outdir)
+
+def cli(argv = None):
+	parser = build_parser()
+	params = vars(parser.parse_args(argv))
+	try:
+		configure(params)
+	except ValueError as error:
+		parser.error(str(error))
+	run_pipeline(params, "Admixture")
 
 
 if __name__ == '__main__':
-	main(pop1, pop2, pop3, time_admix, prop_pop1, prop_pop2, chrom, dem_option, sample_pop1, sample_pop2, sample_pop3)
+	cli()
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+
+##########################################################################################
+# Batch scheduling for model_admix.py sweeps                                             #
+#                                                                                        #
+# Splits the parameter sets of a sweep file (see sweep.py) into tasks, one per           #
+# chromosome, parameter set and replicate, sizes each task's memory and time from the    #
+# tasks that already finished (or from model_admix.py --estimate), packs the tasks into  #
+# jobs and either runs the jobs on local cores or writes SLURM job-array scripts for     #
+# them. Every task leaves status.json in its own directory; --collect gathers them into  #
+# <sweep_dir>/manifest.jsonl, in the same layout sweep.py writes.                        #
+##########################################################################################
+
+#Usage:
+#	python scheduler.py sweep.json --cpus 16 --memory 64                (run the jobs here)
+#	python scheduler.py sweep.json --executor slurm --partition long    (write sweep/slurm/plan-<time>/*.sh)
+#	bash sweep/slurm/plan-<time>/submit.sh
+#	python scheduler.py --collect                                       (statuses into manifest.jsonl)
+#
+#Besides the model_admix.py parameters, a parameter set can hold "replicates" (that many tasks per
+#chromosome, seeded as sweep.py seeds its replicate runs), and "cpus", "mem_gb" and "hours" to override the sizing.
+#A chromosome list or range becomes one task per chromosome, so no merged fileset is made.
+
+import argparse
+import glob
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+import model_admix
+import sweep
+
+dep_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Dependencies")
+sys.path.insert(0, dep_dir)
+import estimate
+
+#tasks with the same values for these cost about the same for the same number of samples:
+#the same stretch of the same chromosome, through the same stages run by the same engines
+shape_keys = ['chrom', 'start', 'end', 'length', 'scale', 'dem_option', 'backend', 'ancestry_model',
+'plink_convert', 'maf', 'export', 'subsample', 'mutation_replicates', 'mutation_rates',
+'only', 'run_from', 'pca_engine', 'prune_engine', 'freq_engine', 'vcf_engine', 'admixture_engine']
+
+#model_admix.py's option defaults, so leaving an option out and giving its default value have the same shape
+option_defaults = model_admix.default_options()
+
+#predicted memory and time are multiplied by this before they are requested
+default_margin = 1.5
+
+#smallest requests, in GB and hours
+min_mem_gb = 1.0
+min_hours = 0.25
+
+
+#One task per chromosome and parameter set (replicates are already separate sets, see sweep.expand_replicates)
+def expand_tasks(param_sets):
+	return [dict(params, chrom = chrom) for params in param_sets for chrom in sweep.expand_chroms(params['chrom'])]
+
+
+#A parameter set gives --from as "from" (see sweep.command_line)
+def task_shape(params):
+	params = dict(params)
+	if 'from' in params:
+		params['run_from'] = params.pop('from')
+	return json.dumps({name: params.get(name, option_defaults.get(name)) for name in shape_keys}, sort_keys = True)
+
+
+def task_samples(params):
+	return int(params['sample_pop1']) + int(params['sample_pop2']) + int(params['sample_pop3'])
+
+
+def status_path(sweep_dir, rid):
+	return os.path.join(sweep_dir, rid, "status.json")
+
+
+def read_status(sweep_dir, rid):
+	path = status_path(sweep_dir, rid)
+	if not os.path.exists(path):
+		return None
+	with open(path, "r") as file:
+		return json.load(file)
+
+
+#Written to a temporary file first, so a reader never sees half a record
+def write_status(sweep_dir, record):
+	path = status_path(sweep_dir, record['run_id'])
+	with open(path + ".tmp", "w") as file:
+		json.dump(record, file, indent = 1, sort_keys = True)
+	os.replace(path + ".tmp", path)
+
+
+#Tasks that finished in these sweep directories, with the memory and time they took
+def read_history(dirs):
+	history = []
+	for sweep_dir in dirs:
+		for path in glob.glob(os.path.join(sweep_dir, "*", "status.json")):
+			with open(path, "r") as file:
+				record = json.load(file)
+			if record.get('status') == 'done' and record.get('peak_rss'):
+				history.append(record)
+	return history
+
+
+#Peak memory (bytes) and wall time (s) of a task from finished tasks of the same shape:
+#a straight line through (total sample size, value) when there are two or more sample sizes,
+#otherwise the most any of them took, scaled up by sample size. None when nothing matches
+def predict(params, history):
+	shape = task_shape(params)
+	runs = [record for record in history if task_shape(record['params']) == shape]
+	if not runs:
+		return None
+	n = task_samples(params)
+	sizes = [task_samples(record['params']) for record in runs]
+	if len(set(sizes)) >= 2:
+		return (estimate.extrapolate_linear(sizes, [record['peak_rss'] for record in runs], n),
+		estimate.extrapolate_linear(sizes, [record['wall_time'] for record in runs], n))
+	scale = max(1.0, n / sizes[0])
+	return (max(record['peak_rss'] for record in runs) * scale, max(record['wall_time'] for record in runs) * scale)
+
+
+#Simulation memory and time from model_admix.py --estimate, for tasks nothing has been learned about yet
+#Each estimate is kept in <sweep_dir>/estimates/<run_id>, so it is only made once
+def estimate_task(params, rid, sweep_dir):
+	run_dir = os.path.join(sweep_dir, "estimates", rid)
+	path = os.path.join(run_dir, "Admixture", "estimate_" + str(params['chrom']) + ".json")
+	if not os.path.exists(path):
+		os.makedirs(run_dir, exist_ok = True)
+		print("ESTIMATING", rid, flush = True)
+		with open(os.path.join(run_dir, "estimate.log"), "w") as log:
+			subprocess.run(sweep.command_line(params) + ['--estimate'], cwd = run_dir, stdout = log,
+			stderr = subprocess.STDOUT)
+		if not os.path.exists(path):
+			print("ESTIMATE FAILED", rid, "SEE", os.path.join(run_dir, "estimate.log"), flush = True)
+			return None
+	with open(path, "r") as file:
+		total = json.load(file)['total']
+	return total['peak_rss'], total['wall_time']
+
+
+#Cores, memory (GB) and time (hours) to ask for; values given in the parameter set win
+def size_task(params, predicted, mem_per_run, hours_per_run, margin):
+	if predicted is None:
+		mem_gb, hours = mem_per_run, hours_per_run
+	else:
+		mem_gb = max(min_mem_gb, math.ceil(2 * margin * predicted[0] / 1e9) / 2)
+		hours = max(min_hours, math.ceil(4 * margin * predicted[1] / 3600) / 4)
+	return {'cpus': sweep.run_cpus(params), 'mem_gb': float(params.get('mem_gb', mem_gb)),
+		'hours': float(params.get('hours', hours))}
+
+
+#Tasks needing the same cores and memory share jobs of up to tasks_per_job tasks, run one after
+#another, so a job asks for what its tasks need and for the time of all of them
+def pack_jobs(tasks, tasks_per_job):
+	classes = {}
+	for rid, task in tasks.items():
+		classes.setdefault((task['cpus'], task['mem_gb']), []).append(rid)
+	jobs = []
+	for (cpus, mem_gb), rids in sorted(classes.items()):
+		for start in range(0, len(rids), tasks_per_job):
+			group = rids[start:start + tasks_per_job]
+			jobs.append({'job': len(jobs), 'cpus': cpus, 'mem_gb': mem_gb,
+				'hours': sum(tasks[rid]['hours'] for rid in group), 'tasks': group})
+	return jobs
+
+
+#A task runs model_admix.py in <sweep_dir>/<run_id> with plink held to the task's cores
+def task_command(task):
+	params = task['params']
+	cmd = sweep.command_line(params)
+	if 'plink_threads' not in params:
+		cmd.extend(['--plink-threads', str(max(1, task['cpus'] // int(params.get('jobs', 1))))])
+	return cmd
+
+
+#Run one task and record its exit status, cost and outputs in its status.json
+def run_task(rid, task, sweep_dir):
+	run_dir = os.path.join(sweep_dir, rid)
+	os.makedirs(run_dir, exist_ok = True)
+	record = {'run_id': rid, 'params': task['params'], 'cpus': task['cpus'], 'mem_gb': task['mem_gb'],
+		'hours': task['hours'], 'host': os.uname().nodename, 'status': 'running', 'started': time.time()}
+	write_status(sweep_dir, record)
+	print("STARTED", rid, flush = True)
+
+	with open(os.path.join(run_dir, "run.log"), "w") as log:
+		proc = subprocess.Popen(task_command(task), cwd = run_dir, stdout = log, stderr = subprocess.STDOUT)
+		_, wait_status, usage = os.wait4(proc.pid, 0)
+	returncode = os.waitstatus_to_exitcode(wait_status)
+
+	record.update({'status': 'done' if returncode == 0 else 'failed', 'returncode': returncode,
+		'finished': time.time(), 'wall_time': time.time() - record['started'],
+		'cpu_time': usage.ru_utime + usage.ru_stime, 'peak_rss': usage.ru_maxrss * 1024,
+		'run_dir': run_dir, 'outputs': sweep.list_outputs(run_dir)})
+	write_status(sweep_dir, record)
+	print(record['status'].upper(), rid, flush = True)
+	return returncode == 0
+
+
+#What a job-array element or local job runs: its tasks one after another, skipping finished ones
+def run_job(plan, index):
+	failed = 0
+	for rid in plan['jobs'][index]['tasks']:
+		status = read_status(plan['sweep_dir'], rid)
+		if status is not None and status['status'] == 'done':
+			continue
+		if not run_task(rid, plan['tasks'][rid], plan['sweep_dir']):
+			failed += 1
+	return failed
+
+
+#Every scheduling run writes its own plan-<time>.json, so job arrays still queued from an earlier one
+#keep reading the plan their job indices refer to
+def new_plan_path(sweep_dir):
+	stem = os.path.join(sweep_dir, "plan-" + time.strftime("%Y%m%d-%H%M%S"))
+	path = stem + ".json"
+	n = 1
+	while os.path.exists(path):
+		n += 1
+		path = stem + "-" + str(n) + ".json"
+	return path
+
+
+#The most recent plan of the sweep directory (plan.json as written before plans were kept per run)
+def latest_plan(sweep_dir):
+	paths = glob.glob(os.path.join(sweep_dir, "plan-*.json")) + glob.glob(os.path.join(sweep_dir, "plan.json"))
+	return max(paths, key = os.path.getmtime) if paths else None
+
+
+def job_command(plan_path, index):
+	return [sys.executable, os.path.abspath(__file__), "--run-job", str(index), "--plan", plan_path]
+
+
+#Local executor: jobs run as separate processes, started while they fit in the core and memory
+#budget (a job bigger than the whole budget is started on its own rather than never)
+def run_local(plan, plan_path, cpus, memory_gb, poll = 1.0):
+	log_dir = os.path.join(plan['sweep_dir'], "logs")
+	os.makedirs(log_dir, exist_ok = True)
+	pending = list(plan['jobs'])
+	running = {}
+	used_cpus = 0
+	used_mem = 0.0
+
+	while pending or running:
+		while pending and (not running or (used_cpus + pending[0]['cpus'] <= cpus and
+			used_mem + pending[0]['mem_gb'] <= memory_gb)):
+			job = pending.pop(0)
+			log = open(os.path.join(log_dir, "job_" + str(job['job']) + ".log"), "w")
+			proc = subprocess.Popen(job_command(plan_path, job['job']), stdout = log, stderr = subprocess.STDOUT)
+			running[job['job']] = (proc, log, job)
+			used_cpus += job['cpus']
+			used_mem += job['mem_gb']
+
+		time.sleep(poll)
+
+		for index in list(running):
+			proc, log, job = running[index]
+			if proc.poll() is None:
+				continue
+			log.close()
+			del running[index]
+			used_cpus -= job['cpus']
+			used_mem -= job['mem_gb']
+
+
+def slurm_time(hours):
+	minutes = int(math.ceil(hours * 60))
+	days, minutes = divmod(minutes, 24 * 60)
+	return (str(days) + "-" if days else "") + "%02d:%02d:00" % divmod(minutes, 60)
+
+
+#The scripts of each plan are kept together in slurm/<plan name>/ next to it
+def slurm_dir_of(plan_path):
+	return os.path.join(os.path.dirname(plan_path), "slurm", os.path.splitext(os.path.basename(plan_path))[0])
+
+
+#One job-array script per resource class (an array shares one resource request), plus submit.sh
+def write_slurm(plan, plan_path, partition = None, account = None, max_parallel = None):
+	slurm_dir = slurm_dir_of(plan_path)
+	log_dir = os.path.join(plan['sweep_dir'], "logs")
+	os.makedirs(slurm_dir, exist_ok = True)
+	os.makedirs(log_dir, exist_ok = True)
+
+	classes = {}
+	for job in plan['jobs']:
+		classes.setdefault((job['cpus'], job['mem_gb']), []).append(job)
+
+	scripts = []
+	for k, ((cpus, mem_gb), jobs) in enumerate(sorted(classes.items())):
+		path = os.path.join(slurm_dir, "array_" + str(k) + ".sh")
+		lines = ["#!/bin/bash",
+			"#SBATCH --job-name=model_admix_" + str(k),
+			"#SBATCH --array=0-" + str(len(jobs) - 1) + ("%" + str(max_parallel) if max_parallel else ""),
+			"#SBATCH --cpus-per-task=" + str(cpus),
+			"#SBATCH --mem=" + str(int(math.ceil(mem_gb * 1024))) + "M",
+			"#SBATCH --time=" + slurm_time(max(job['hours'] for job in jobs)),
+			"#SBATCH --output=" + os.path.join(log_dir, "%x_%A_%a.log")]
+		if partition:
+			lines.append("#SBATCH --partition=" + partition)
+		if account:
+			lines.append("#SBATCH --account=" + account)
+		lines += ["", "#jobs of " + os.path.basename(plan_path) + " this array runs, one per element",
+			"jobs=(" + " ".join(str(job['job']) for job in jobs) + ")",
+			sys.executable + " " + os.path.abspath(__file__) + " --run-job ${jobs[$SLURM_ARRAY_TASK_ID]} --plan " + plan_path]
+		with open(path, "w") as file:
+			file.write("\n".join(lines) + "\n")
+		scripts.append(path)
+
+	with open(os.path.join(slurm_dir, "submit.sh"), "w") as file:
+		file.write("#!/bin/bash\n" + "".join("sbatch " + path + "\n" for path in scripts))
+	return scripts
+
+
+#Latest status of every task in the sweep directory (and of the plan's tasks that have not started),
+#appended to manifest.jsonl when it changed
+def collect(plan):
+	sweep_dir = plan['sweep_dir']
+	manifest = os.path.join(sweep_dir, "manifest.jsonl")
+	records = sweep.read_manifest(manifest)
+	statuses = {}
+	for path in sorted(glob.glob(os.path.join(sweep_dir, "*", "status.json"))):
+		with open(path, "r") as file:
+			record = json.load(file)
+		statuses[record['run_id']] = record
+	for rid, task in plan['tasks'].items():
+		if rid not in statuses:
+			statuses[rid] = {'run_id': rid, 'params': task['params'], 'status': 'pending'}
+	counts = {}
+	for rid, record in statuses.items():
+		if records.get(rid) != record:
+			sweep.append_manifest(manifest, record)
+		counts[record['status']] = counts.get(record['status'], 0) + 1
+	print("COLLECTED:", ", ".join(str(n) + " " + status.upper() for status, n in sorted(counts.items())),
+	"IN", manifest, flush = True)
+	return counts
+
+
+def main():
+	parser = argparse.ArgumentParser(description = "Schedule a model_admix.py sweep as sized jobs, locally or as SLURM job arrays")
+	parser.add_argument("sweep_file", nargs = "?", help = "JSON file with base, grid and/or runs (see sweep.py)")
+	parser.add_argument("--sweep-dir", default = "sweep",
+		help = "directory for task directories, plans, scripts and manifest.jsonl (default sweep)")
+	parser.add_argument("--executor", choices = ['local', 'slurm'], default = 'local',
+		help = "run the jobs on this machine (local, default) or write SLURM job-array scripts (slurm)")
+	parser.add_argument("--cpus", type = int, default = os.cpu_count(),
+		help = "cores available to the local executor (default: all)")
+	parser.add_argument("--memory", type = float, default = sweep.total_memory_gb(),
+		help = "memory available to the local executor in GB (default: physical memory)")
+	parser.add_argument("--mem-per-run", type = float, default = 4,
+		help = "memory in GB for tasks with no history or estimate (default 4)")
+	parser.add_argument("--hours-per-run", type = float, default = 4,
+		help = "time in hours for tasks with no history or estimate (default 4)")
+	parser.add_argument("--margin", type = float, default = default_margin,
+		help = "predicted memory and time are multiplied by this (default 1.5)")
+	parser.add_argument("--history", action = "append", default = [],
+		help = "also size tasks from the finished tasks of this sweep directory (repeatable)")
+	parser.add_argument("--estimate", action = "store_true",
+		help = "size tasks with no history from model_admix.py --estimate (simulation time and memory)")
+	parser.add_argument("--tasks-per-job", type = int, default = 1,
+		help = "tasks with the same cores and memory run one after another in a job of up to this many (default 1)")
+	parser.add_argument("--retry-failed", action = "store_true",
+		help = "schedule tasks whose last attempt failed again")
+	parser.add_argument("--partition", help = "SLURM partition")
+	parser.add_argument("--account", help = "SLURM account")
+	parser.add_argument("--max-parallel", type = int, help = "most elements of each job array running at once")
+	parser.add_argument("--collect", action = "store_true",
+		help = "gather the status of every task of the sweep directory into manifest.jsonl and stop")
+	parser.add_argument("--run-job", type = int, help = argparse.SUPPRESS)
+	parser.add_argument("--plan", help = argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	sweep_dir = os.path.abspath(args.sweep_dir)
+
+	if args.run_job is not None or args.collect:
+		plan_path = args.plan or latest_plan(sweep_dir)
+		if plan_path is None or not os.path.exists(plan_path):
+			sys.exit("No plan in " + sweep_dir + ", schedule a sweep file first")
+		with open(plan_path, "r") as file:
+			plan = json.load(file)
+		if args.run_job is not None:
+			sys.exit(1 if run_job(plan, args.run_job) else 0)
+		counts = collect(plan)
+		sys.exit(1 if counts.get('failed') else 0)
+
+	if args.sweep_file is None:
+		parser.error("a sweep file is needed unless --collect is given")
+	with open(args.sweep_file, "r") as file:
+		param_sets = sweep.expand_sweep(json.load(file))
+
+	os.makedirs(sweep_dir, exist_ok = True)
+	history = read_history([sweep_dir] + args.history)
+	tasks = {}
+	skipped = 0
+	for params in expand_tasks(param_sets):
+		rid = sweep.run_id(params)
+		status = read_status(sweep_dir, rid)
+		if status is not None and (status['status'] == 'done' or (status['status'] == 'failed' and not args.retry_failed)):
+			skipped += 1
+			continue
+		predicted, sized_from = predict(params, history), 'history'
+		if predicted is None and args.estimate:
+			predicted, sized_from = estimate_task(params, rid, sweep_dir), 'estimate'
+		if predicted is None:
+			sized_from = 'default'
+		tasks[rid] = dict(size_task(params, predicted, args.mem_per_run, args.hours_per_run, args.margin), 
+			params = params, sized_from = sized_from)
+		print("TASK", rid, "CHROMOSOME", params['chrom'], ":", tasks[rid]['cpus'], "CPUS,", tasks[rid]['mem_gb'], "GB,",
+		tasks[rid]['hours'], "H (" + tasks[rid]['sized_from'].upper() + ")", flush = True)
+
+	plan = {'sweep_dir': sweep_dir, 'created': time.time(), 'tasks': tasks,
+		'jobs': pack_jobs(tasks, max(1, args.tasks_per_job))}
+	plan_path = new_plan_path(sweep_dir)
+	with open(plan_path, "w") as file:
+		json.dump(plan, file, indent = 1, sort_keys = True)
+	print("PLANNED", len(tasks), "TASKS IN", len(plan['jobs']), "JOBS,", skipped, "ALREADY FINISHED:", plan_path, flush = True)
+
+	if args.executor == 'slurm':
+		scripts = write_slurm(plan, plan_path, args.partition, args.account, args.max_parallel)
+		print("WROTE", len(scripts), "JOB ARRAYS, SUBMIT WITH: bash " + os.path.join(slurm_dir_of(plan_path), "submit.sh"),
+		"THEN RUN: python scheduler.py --collect --sweep-dir " + args.sweep_dir, flush = True)
+		return
+
+	run_local(plan, plan_path, args.cpus, args.memory)
+	counts = collect(plan)
+	sys.exit(1 if counts.get('failed') else 0)
+
+
+if __name__ == '__main__':
+	main()
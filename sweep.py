@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+##########################################################################################
+# Parameter sweeps over model_admix.py                                                   #
+#                                                                                        #
+# Takes a JSON sweep file with a grid and/or a list of parameter sets, runs each set     #
+# through model_admix.py on local cores under a CPU and memory budget, and records       #
+# every run's status and outputs in <sweep_dir>/manifest.jsonl. Rerunning the same sweep #
+# skips parameter sets that already completed, so an interrupted sweep simply resumes.   #
+##########################################################################################
+
+#Example sweep file:
+#{
+#	"base": {"pop1": 10000, "pop2": 10000, "pop3": 5000, "chrom": 22,
+#		"sample_pop1": 20, "sample_pop2": 20, "sample_pop3": 20, "seed": 1},
+#	"grid": {"time_admix": [3000, 6000], "prop_pop1": [0.2, 0.5],
+#		"dem_option": ["constant", "collapse"]},
+#	"runs": [{"time_admix": 9000, "prop_pop1": 0.9, "dem_option": "expansion"}]
+#}
+#prop_pop2 defaults to 1 - prop_pop1. Any model_admix.py option can be given by name
+#(e.g. "seed", "workers", "cache_dir", "run_from"), lists as JSON lists ("only": ["pca", "prune"],
+#"subsample": [[10, 10, 10], [5, 5, 5]]). "mem_gb" sets the memory a run is expected to need,
+#"cpus" the cores it may use (default: its --workers or --jobs). "replicates": N runs the set N times
+#with seeds derived from "seed" (see expand_replicates); model_admix.py's own --replicates is not used.
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import model_admix as pipeline
+
+model_admix = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_admix.py")
+
+#positional arguments of model_admix.py, in order
+positional = ['pop1', 'pop2', 'pop3', 'time_admix', 'prop_pop1', 'prop_pop2', 'chrom',
+'dem_option', 'sample_pop1', 'sample_pop2', 'sample_pop3']
+
+#keys that size a run but do not change its results
+resource_keys = ['mem_gb', 'cpus', 'hours']
+
+#keys that tell apart runs of the same parameter set but are not model_admix.py options
+task_keys = ['replicate']
+
+
+#Replicate r of a parameter set gets its own seed, derived from the set's seed
+def replicate_seed(seed, replicate):
+	return int(np.random.SeedSequence([int(seed), replicate]).generate_state(1)[0])
+
+
+#"replicates": N in a parameter set means N separate runs, here and in scheduler.py, each with its own
+#seed derived from the set's. A set without a seed gets one derived from its parameters, so its
+#replicates differ (and can be cached) while keeping the same run IDs each time the sweep is read
+def expand_replicates(params):
+	params = dict(params)
+	replicates = params.pop('replicates', None)
+	if replicates is None:
+		return [params]
+	seed = params.get('seed')
+	if seed is None:
+		seed = int(run_id(params), 16) % 2**63
+	return [dict(params, replicate = r, seed = replicate_seed(seed, r)) for r in range(1, int(replicates) + 1)]
+
+
+#Expand the sweep file into a list of complete parameter sets, one per replicate
+def expand_sweep(sweep):
+	base = sweep.get('base', {})
+	param_sets = []
+
+	grid = sweep.get('grid', {})
+	if grid:
+		names = sorted(grid)
+		for values in itertools.product(*[grid[name] for name in names]):
+			param_sets.append(dict(base, **dict(zip(names, values))))
+
+	for run in sweep.get('runs', []):
+		param_sets.append(dict(base, **run))
+
+	if not param_sets:
+		param_sets.append(dict(base))
+
+	for params in param_sets:
+		#runs execute in their own directories, so paths are made absolute here
+		if params.get('cache_dir'):
+			params['cache_dir'] = os.path.abspath(params['cache_dir'])
+		if 'prop_pop2' not in params and 'prop_pop1' in params:
+			params['prop_pop2'] = round(1 - params['prop_pop1'], 10)
+		missing = [name for name in positional if name not in params]
+		if missing:
+			sys.exit("Parameter set " + json.dumps(params) + " is missing " + ", ".join(missing))
+	return [replicate for params in param_sets for replicate in expand_replicates(params)]
+
+
+#Short stable ID for a parameter set, used for its directory and manifest entries
+def run_id(params):
+	key = {name: value for name, value in params.items() if name not in resource_keys}
+	return hashlib.sha256(json.dumps(key, sort_keys = True).encode()).hexdigest()[:16]
+
+
+#model_admix.py's options by parameter name, as its parser defines them
+def pipeline_options():
+	parser = argparse.ArgumentParser(add_help = False)
+	pipeline.add_options(parser)
+	return {action.dest: action for action in parser._actions}
+
+
+#A list for an option taking one value is given comma separated, as model_admix.py reads --only,
+#--mutation-rates and chromosome lists
+def as_spec(value):
+	return ",".join(str(v) for v in value) if isinstance(value, (list, tuple)) else str(value)
+
+
+#The model_admix.py command line for params: list values of an option taking several values become one
+#argument each, and a repeatable one (--subsample) is repeated for each list of values
+def command_line(params):
+	options = pipeline_options()
+	cmd = [sys.executable, model_admix] + [as_spec(params[name]) for name in positional]
+	for name in sorted(params):
+		if name in positional or name in resource_keys or name in task_keys:
+			continue
+		value = params[name]
+		action = options.get(name)
+		flag = action.option_strings[0] if action is not None else "--" + name.replace("_", "-")
+		if value is True:
+			cmd.append(flag)
+		elif value is False or value is None:
+			continue
+		elif action is not None and action.nargs not in (None, '?') and isinstance(value, (list, tuple)):
+			repeated = isinstance(action, argparse._AppendAction) and all(isinstance(v, (list, tuple)) for v in value)
+			for values in (value if repeated else [value]):
+				cmd.extend([flag] + [str(v) for v in values])
+		else:
+			cmd.extend([flag, as_spec(value)])
+	return cmd
+
+
+#Chromosomes named by a chrom parameter (a number, a list, a range or all), read by model_admix.py's own parser
+def expand_chroms(chrom):
+	return pipeline.parse_chroms(as_spec(chrom))
+
+
+#A run uses one core per worker, but never more workers than chromosomes, or one per
+#stage it runs at once (--jobs), unless it says how many cores it gets
+def run_cpus(params):
+	if 'cpus' in params:
+		return int(params['cpus'])
+	workers = min(int(params.get('workers', 1)), len(expand_chroms(params['chrom'])))
+	return max(1, workers, int(params.get('jobs', 1)))
+
+
+def total_memory_gb():
+	try:
+		return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1e9
+	except (ValueError, OSError):
+		return 8.0
+
+
+#Latest manifest record for every run ID
+def read_manifest(path):
+	records = {}
+	if os.path.exists(path):
+		with open(path, "r") as file:
+			for line in file:
+				line = line.strip()
+				if not line:
+					continue
+				try:
+					record = json.loads(line)
+				except ValueError:
+					#a line cut short by an interruption
+					continue
+				records[record['run_id']] = record
+	return records
+
+
+def append_manifest(path, record):
+	with open(path, "a") as file:
+		file.write(json.dumps(record, sort_keys = True) + "\n")
+		file.flush()
+		os.fsync(file.fileno())
+
+
+def list_outputs(run_dir):
+	outputs = []
+	for root, _, files in os.walk(os.path.join(run_dir, "Admixture")):
+		for name in files:
+			outputs.append(os.path.relpath(os.path.join(root, name), run_dir))
+	return sorted(outputs)
+
+
+#Start runs while they fit in the CPU and memory budget, and record each one as it finishes
+#A run that needs more than the whole budget is started on its own rather than never
+def run_sweep(param_sets, sweep_dir, cpus, memory_gb, mem_per_run, retry_failed = False, poll = 1.0):
+	os.makedirs(sweep_dir, exist_ok = True)
+	manifest = os.path.join(sweep_dir, "manifest.jsonl")
+	records = read_manifest(manifest)
+
+	pending = []
+	for params in param_sets:
+		rid = run_id(params)
+		status = records.get(rid, {}).get('status')
+		if status == 'done' or (status == 'failed' and not retry_failed):
+			print("SKIPPING", rid, status.upper(), flush = True)
+			continue
+		pending.append((rid, params))
+
+	running = {}
+	used_cpus = 0
+	used_mem = 0.0
+	failed = 0
+
+	while pending or running:
+		started = True
+		while pending and started:
+			started = False
+			rid, params = pending[0]
+			need_cpus = run_cpus(params)
+			need_mem = float(params.get('mem_gb', mem_per_run))
+			if not running or (used_cpus + need_cpus <= cpus and used_mem + need_mem <= memory_gb):
+				pending.pop(0)
+				run_dir = os.path.join(sweep_dir, rid)
+				os.makedirs(run_dir, exist_ok = True)
+				log = open(os.path.join(run_dir, "run.log"), "w")
+				proc = subprocess.Popen(command_line(params), cwd = run_dir, stdout = log,
+				stderr = subprocess.STDOUT)
+				running[rid] = (proc, log, params, need_cpus, need_mem, time.time())
+				used_cpus += need_cpus
+				used_mem += need_mem
+				append_manifest(manifest, {'run_id': rid, 'params': params, 'status': 'running',
+				'started': time.time()})
+				print("STARTED", rid, flush = True)
+				started = True
+
+		time.sleep(poll)
+
+		for rid in list(running):
+			proc, log, params, need_cpus, need_mem, start = running[rid]
+			if proc.poll() is None:
+				continue
+			log.close()
+			del running[rid]
+			used_cpus -= need_cpus
+			used_mem -= need_mem
+			status = 'done' if proc.returncode == 0 else 'failed'
+			if status == 'failed':
+				failed += 1
+			run_dir = os.path.join(sweep_dir, rid)
+			append_manifest(manifest, {'run_id': rid, 'params': params, 'status': status,
+			'returncode': proc.returncode, 'started': start, 'finished': time.time(),
+			'wall_time': time.time() - start, 'run_dir': run_dir, 'outputs': list_outputs(run_dir)})
+			print(status.upper(), rid, flush = True)
+
+	print("SWEEP FINISHED:", failed, "FAILED", flush = True)
+	return failed
+
+
+def main():
+	parser = argparse.ArgumentParser(description = "Run a parameter sweep over model_admix.py")
+	parser.add_argument("sweep_file", help = "JSON file with base, grid and/or runs")
+	parser.add_argument("--sweep-dir", default = "sweep",
+		help = "directory for run directories and manifest.jsonl (default sweep)")
+	parser.add_argument("--cpus", type = int, default = os.cpu_count(),
+		help = "cores available to the sweep (default: all)")
+	parser.add_argument("--memory", type = float, default = total_memory_gb(),
+		help = "memory available to the sweep in GB (default: physical memory)")
+	parser.add_argument("--mem-per-run", type = float, default = 4,
+		help = "memory assumed for runs without mem_gb, in GB (default 4)")
+	parser.add_argument("--retry-failed", action = "store_true",
+		help = "rerun parameter sets whose last attempt failed")
+	args = parser.parse_args()
+
+	with open(args.sweep_file, "r") as file:
+		sweep = json.load(file)
+
+	param_sets = expand_sweep(sweep)
+	print("PARAMETER SETS:", len(param_sets), flush = True)
+	failed = run_sweep(param_sets, args.sweep_dir, args.cpus, args.memory, args.mem_per_run,
+	retry_failed = args.retry_failed)
+	sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+#model_admix.py and the Dependencies modules are imported the way the pipeline imports them
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "Dependencies"))
+import plink_io
+
+
+#A plink fileset at prefix holding dosage (variants x individuals, A1 copies, -1 missing), chroms giving each variant's chromosome
+@pytest.fixture
+def write_fileset():
+	def write(prefix, dosage, chroms):
+		n_snps, n_ind = dosage.shape
+		plink_io.write_fam(prefix, n_ind)
+		with open(prefix + ".bim", "w") as bim:
+			for k, chrom in enumerate(chroms):
+				bim.write(str(chrom) + "\tsnp" + str(k) + "\t0\t" + str(1000 * (k + 1)) + "\tT\tA\n")
+		codes = np.zeros((n_snps, 4 * ((n_ind + 3) // 4)), dtype = np.uint8)
+		codes[:, :n_ind] = np.where(dosage < 0, 1, plink_io.bed_codes[np.maximum(dosage, 0)])
+		with open(prefix + ".bed", "wb") as bed:
+			bed.write(plink_io.bed_magic + plink_io.pack_bed_block(codes))
+	return write
@@ -0,0 +1,57 @@
+import itertools
+import os
+
+import numpy as np
+
+import ancestry
+
+
+#Genotypes drawn from the ADMIXTURE model with known Q: unadmixed individuals from each of two
+#populations and individuals 30/70 admixed between them, with 1% of the calls missing
+def admixed_genotypes(seed):
+	rng = np.random.default_rng(seed)
+	p = np.column_stack([rng.beta(0.5, 0.5, 2000), rng.beta(0.5, 0.5, 2000)]).clip(0.01, 0.99)
+	q = np.array([[1.0, 0.0]] * 20 + [[0.0, 1.0]] * 20 + [[0.3, 0.7]] * 20)
+	geno = rng.binomial(2, p @ q.T).astype(np.int8)
+	geno[rng.random(geno.shape) < 0.01] = -1
+	return geno, q
+
+
+def q_error(fitted, true):
+	return min(np.abs(fitted[:, order] - true).mean() for order in itertools.permutations(range(true.shape[1])))
+
+
+def test_em_recovers_ancestry_proportions():
+	geno, q = admixed_genotypes(seed = 1)
+	p_fit, q_fit, loglik, steps = ancestry.fit(geno, 2)
+	assert np.allclose(q_fit.sum(axis = 1), 1)
+	assert p_fit.min() >= ancestry.min_value and p_fit.max() <= ancestry.max_value
+	assert q_error(q_fit, q) < 0.03
+	assert steps < ancestry.max_iterations
+
+	#the fit from a different start reaches the same likelihood, and threads do not change the result
+	_, q_other, loglik_other, _ = ancestry.fit(geno, 2, seed = 7)
+	assert abs(loglik_other - loglik) < 1
+	assert q_error(q_other, q) < 0.03
+	_, q_threads, loglik_threads, _ = ancestry.fit(geno, 2, threads = 3)
+	assert np.allclose(q_threads, q_fit) and np.isclose(loglik_threads, loglik)
+
+
+def test_cross_validation_prefers_the_true_k(tmp_path, write_fileset):
+	geno, q = admixed_genotypes(seed = 2)
+	prefix = str(tmp_path / "pruned_model_1")
+	write_fileset(prefix, geno, [1] * len(geno))
+
+	cwd = os.getcwd()
+	os.chdir(tmp_path)
+	try:
+		results = {K: ancestry.run_admixture(prefix, K) for K in (1, 2)}
+	finally:
+		os.chdir(cwd)
+	assert results[2]['cv_error'] < results[1]['cv_error']
+	assert results[2]['loglikelihood'] > results[1]['loglikelihood']
+
+	q_written = np.loadtxt(str(tmp_path / "pruned_model_1.2.Q"))
+	p_written = np.loadtxt(str(tmp_path / "pruned_model_1.2.P"))
+	assert q_written.shape == (60, 2) and p_written.shape == (2000, 2)
+	assert q_error(q_written, q) < 0.03
@@ -0,0 +1,103 @@
+import gzip
+import struct
+
+import bgzf
+
+header = "##fileformat=VCFv4.2\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tmsp_00\n"
+
+
+#Enough records for several BGZF blocks, on two chromosomes, with some REF alleles longer than one base
+def records():
+	for chrom, n in (("1", 2500), ("2", 1500)):
+		for k in range(n):
+			pos = 1 + 997 * k
+			ref = "ACGT"[:1 + k % 4]
+			line = chrom + "\t" + str(pos) + "\t" + chrom + "_" + str(k) + "\t" + ref + "\tT\t.\tPASS\t.\tGT\t" + "0|1\t" * (k % 40) + "1|1\n"
+			yield line, chrom, pos, len(ref)
+
+
+#The uncompressed stream and a function giving the stream offset of a virtual offset
+def decompress(path):
+	starts = {}
+	data = b""
+	for coffset, next_coffset, block in bgzf.read_blocks(path):
+		starts[coffset] = len(data)
+		data += block
+		assert len(block) <= bgzf.max_block
+	starts[next_coffset] = len(data)
+	return data, lambda voffset: starts[voffset >> 16] + (voffset & 0xffff)
+
+
+def read_tbi(path):
+	data, _ = decompress(path)
+	magic, (n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm) = data[:4], struct.unpack("<8i", data[4:36])
+	assert magic == b"TBI\1" and (fmt, col_seq, col_beg, meta) == (2, 1, 2, ord('#'))
+	names = data[36:36 + l_nm].split(b"\0")[:n_ref]
+	pos = 36 + l_nm
+	index = {}
+	for name in names:
+		bins = {}
+		(n_bin,) = struct.unpack("<i", data[pos:pos + 4])
+		pos += 4
+		for _ in range(n_bin):
+			bin_id, n_chunk = struct.unpack("<Ii", data[pos:pos + 8])
+			pos += 8
+			bins[bin_id] = [struct.unpack("<QQ", data[pos + 16 * c:pos + 16 * c + 16]) for c in range(n_chunk)]
+			pos += 16 * n_chunk
+		(n_intv,) = struct.unpack("<i", data[pos:pos + 4])
+		linear = struct.unpack("<" + str(n_intv) + "Q", data[pos + 4:pos + 4 + 8 * n_intv])
+		pos += 4 + 8 * n_intv
+		index[name.decode()] = (bins, linear)
+	assert pos == len(data)
+	return index
+
+
+def test_bgzf_file_is_plain_gzip(tmp_path):
+	path = str(tmp_path / "snps.vcf.gz")
+	assert bgzf.write_indexed(path, header, records()) == 4000
+	with open(path, "rb") as file:
+		assert gzip.decompress(file.read()).decode() == header + "".join(line for line, _, _, _ in records())
+	with open(path, "rb") as file:
+		assert file.read()[-len(bgzf.eof_block):] == bgzf.eof_block
+
+
+#Every chunk of every bin resolves to whole records whose [beg, end) fall in that bin, every record is in
+#exactly one chunk, and each 16 kb window of the linear index points at or before its first record
+def test_tbi_offsets_point_at_the_records(tmp_path):
+	path = str(tmp_path / "snps.vcf.gz")
+	bgzf.write_indexed(path, header, records())
+	data, offset = decompress(path)
+	index = read_tbi(path + ".tbi")
+	assert list(index) == ["1", "2"]
+
+	found = []
+	for chrom, (bins, linear) in index.items():
+		first_in_window = {}
+		for bin_id, chunks in bins.items():
+			for start, end in chunks:
+				text = data[offset(start):offset(end)].decode()
+				assert offset(start) == 0 or data[offset(start) - 1:offset(start)] == b"\n"
+				assert text.endswith("\n")
+				for line in text.splitlines():
+					fields = line.split("\t")
+					beg = int(fields[1]) - 1
+					assert fields[0] == chrom
+					assert bgzf.reg2bin(beg, beg + len(fields[3])) == bin_id
+					found.append(line + "\n")
+					line_start = offset(start) + text.index(line + "\n")
+					for window in range(beg >> 14, (beg + len(fields[3]) - 1 >> 14) + 1):
+						first_in_window[window] = min(first_in_window.get(window, line_start), line_start)
+		for window, first in first_in_window.items():
+			assert offset(linear[window]) <= first
+	assert sorted(found) == sorted(line for line, _, _, _ in records())
+
+
+#Indexing the finished file, as is done for plink's bgzipped VCF, gives the same index as writing it
+def test_index_vcf_matches_write_indexed(tmp_path):
+	path = str(tmp_path / "snps.vcf.gz")
+	bgzf.write_indexed(path, header, records())
+	with open(path + ".tbi", "rb") as file:
+		written = file.read()
+	bgzf.index_vcf(path)
+	with open(path + ".tbi", "rb") as file:
+		assert file.read() == written
@@ -0,0 +1,22 @@
+import os
+
+import model_admix
+
+params = {'pop1': 10000, 'pop2': 10000, 'pop3': 5000, 'time_admix': 6000, 'prop_pop1': 0.3, 'prop_pop2': 0.7,
+'chrom': 21, 'dem_option': 'constant', 'sample_pop1': 5, 'sample_pop2': 5, 'sample_pop3': 5, 'length': 200000}
+
+
+def test_unseeded_runs_are_not_cached(tmp_path):
+	cache_dir = str(tmp_path / "cache")
+	first = model_admix.simulate(dict(params, cache_dir = cache_dir))
+	second = model_admix.simulate(dict(params, cache_dir = cache_dir))
+	assert first.tables != second.tables
+	assert not os.path.exists(cache_dir) or not os.listdir(cache_dir)
+
+
+def test_seeded_runs_are_loaded_from_the_cache(tmp_path):
+	cache_dir = str(tmp_path / "cache")
+	first = model_admix.simulate(dict(params, cache_dir = cache_dir, seed = 7))
+	assert os.listdir(cache_dir)
+	second = model_admix.simulate(dict(params, cache_dir = cache_dir, seed = 7))
+	assert first.tables == second.tables
@@ -0,0 +1,33 @@
+import os
+
+import msprime
+
+import estimate
+import plink_io
+import vcf_io
+
+
+#The predicted .bed size is that of the .bed the pipeline writes; the text files' sizes are close
+def test_output_sizes_match_written_files(tmp_path):
+	ts = msprime.sim_ancestry(30, sequence_length = 1e6, recombination_rate = 1e-8, population_size = 10000, random_seed = 3)
+	ts = msprime.sim_mutations(ts, rate = 1e-8, random_seed = 4)
+	prefix = str(tmp_path / "model_1")
+	n_sites = plink_io.write_plink(ts, prefix, 1)
+	vcf_io.write_vcf(ts, prefix + ".vcf", 1)
+
+	predicted = estimate.output_sizes(n_sites, 30, 1, 1e6)
+	assert predicted['bed'] == os.path.getsize(prefix + ".bed")
+	assert abs(predicted['fam'] - os.path.getsize(prefix + ".fam")) < 0.1 * predicted['fam']
+	assert abs(predicted['bim'] - os.path.getsize(prefix + ".bim")) < 0.1 * predicted['bim']
+	assert abs(predicted['vcf'] - os.path.getsize(prefix + ".vcf")) < 0.1 * predicted['vcf']
+
+
+def test_extrapolation():
+	lengths = [1e5, 2e5, 4e5]
+	#sizes: exact on linear data, and never negative
+	assert abs(estimate.extrapolate_linear(lengths, [3 + 2 * l for l in lengths], 1e8) - (3 + 2e8)) < 1e-3 * 2e8
+	assert estimate.extrapolate_linear(lengths, [10, 5, 1], 1e8) >= 0
+	#time: follows a power law through the two longest runs, with the exponent kept within [1, 2]
+	assert abs(estimate.extrapolate_power(lengths, [l ** 1.5 for l in lengths], 1e8) - 1e12) < 1e-6 * 1e12
+	assert abs(estimate.extrapolate_power(lengths, [1, 1, 1], 4e6) - 10) < 1e-9
+	assert abs(estimate.extrapolate_power(lengths, [1, 1, 64], 8e5) - 64 * 4) < 1e-9
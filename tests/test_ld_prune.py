@@ -0,0 +1,82 @@
+import numpy as np
+
+import ld_prune
+
+
+#plink's rules applied directly: slide each chromosome's window by step and, for every pair of
+#remaining variants in the window in order, drop the lower-MAF one (the later one on ties) when r^2 > threshold
+def reference_prune(dosage, chroms, window, step, threshold):
+	g = dosage.astype(np.float64)
+	maf = np.minimum(g.mean(axis = 1) / 2, 1 - g.mean(axis = 1) / 2)
+	removed = np.zeros(len(g), dtype = bool)
+	chroms = np.array(chroms)
+	for chrom in dict.fromkeys(chroms):
+		members = np.nonzero(chroms == chrom)[0]
+		start = 0
+		while True:
+			in_window = members[start:start + window]
+			for a, i in enumerate(in_window):
+				for j in in_window[a + 1:]:
+					if removed[i] or removed[j]:
+						continue
+					if np.corrcoef(g[i], g[j])[0, 1] ** 2 > threshold:
+						if maf[i] < (1 - ld_prune.maf_epsilon) * maf[j]:
+							removed[i] = True
+						else:
+							removed[j] = True
+			if start + window >= len(members):
+				break
+			start += step
+	return ~removed
+
+
+#Haplotype blocks: variants copied from a few founders with a little noise, so r^2 is high within a block
+def correlated_dosage(n_snps, n_ind, seed):
+	rng = np.random.default_rng(seed)
+	dosage = np.zeros((n_snps, n_ind), dtype = np.int8)
+	for start in range(0, n_snps, 12):
+		founder = rng.binomial(2, rng.uniform(0.1, 0.9), n_ind)
+		for k in range(start, min(start + 12, n_snps)):
+			row = founder.copy()
+			flip = rng.random(n_ind) < rng.choice([0.0, 0.02, 0.1, 0.5])
+			row[flip] = rng.binomial(2, 0.5, flip.sum())
+			dosage[k] = row
+	return dosage
+
+
+def test_matches_window_rules(tmp_path, write_fileset):
+	dosage = correlated_dosage(300, 40, seed = 1)
+	chroms = [1] * 170 + [2] * 130
+	prefix = str(tmp_path / "model")
+	write_fileset(prefix, dosage, chroms)
+
+	expected = reference_prune(dosage, chroms, 50, 2, 0.8)
+	assert 0 < expected.sum() < len(expected)
+	#blocks smaller than the window carry pairs across block boundaries
+	for block_size in (None, 7, 1000):
+		assert np.array_equal(ld_prune.prune(prefix, 50, 2, 0.8, block_size = block_size), expected)
+
+
+def test_lower_maf_variant_is_pruned(tmp_path, write_fileset):
+	rng = np.random.default_rng(2)
+	common = rng.binomial(2, 0.5, 100).astype(np.int8)
+	#the same individuals carry it, but rarer: r^2 with the common variant stays above 0.8
+	rare = common.copy()
+	rare[np.nonzero(common == 2)[0][:3]] = 1
+	independent = rng.binomial(2, 0.3, 100).astype(np.int8)
+	prefix = str(tmp_path / "model")
+	write_fileset(prefix, np.array([rare, independent, common, common]), [1, 1, 1, 1])
+
+	keep = ld_prune.write_prune_lists(prefix, prefix, window = 50, step = 2, threshold = 0.8)
+	assert list(keep) == [False, True, True, False]
+	with open(prefix + ".prune.in") as file:
+		assert file.read().split() == ["snp1", "snp2"]
+	with open(prefix + ".prune.out") as file:
+		assert file.read().split() == ["snp0", "snp3"]
+
+
+def test_pairs_on_different_chromosomes_are_not_compared(tmp_path, write_fileset):
+	row = np.random.default_rng(3).binomial(2, 0.4, 60).astype(np.int8)
+	prefix = str(tmp_path / "model")
+	write_fileset(prefix, np.array([row, row, row]), [1, 2, 3])
+	assert ld_prune.prune(prefix).all()
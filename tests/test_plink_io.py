@@ -0,0 +1,54 @@
+import msprime
+import numpy as np
+
+import plink_io
+
+#7 individuals, so the last byte of each .bed record is padded
+def simulate():
+	ts = msprime.sim_ancestry(7, sequence_length = 200000, recombination_rate = 1e-8, population_size = 10000, random_seed = 5)
+	return msprime.sim_mutations(ts, rate = 1e-8, random_seed = 6)
+
+
+def expected_variants(ts):
+	dosages = []
+	bim = []
+	for variant, pos in zip(ts.variants(), plink_io.site_positions(ts)):
+		if len(variant.alleles) == 2:
+			dosages.append(variant.genotypes[0::2] + variant.genotypes[1::2])
+			bim.append((pos, variant.alleles[1], variant.alleles[0]))
+	return np.array(dosages), bim
+
+
+#What write_plink writes (across several of its blocks) is read back by read_bed (across blocks of another size)
+#as the derived allele counts of each individual, with the matching .bim and .fam
+def test_bed_round_trip(tmp_path):
+	ts = simulate()
+	prefix = str(tmp_path / "model_1")
+	n_snps = plink_io.write_plink(ts, prefix, 1, block_size = 7)
+	dosage, bim = expected_variants(ts)
+	assert n_snps == len(dosage) > 20
+
+	read = np.concatenate(list(plink_io.read_bed(prefix, block_size = 5)))
+	assert read.dtype == np.int8
+	assert np.array_equal(read, dosage)
+
+	with open(prefix + ".bim") as file:
+		lines = [line.split() for line in file]
+	assert [line[0] for line in lines] == ["1"] * n_snps
+	assert [line[1] for line in lines] == [str(k + 1) for k in range(n_snps)]
+	assert [(int(line[3]), line[4], line[5]) for line in lines] == bim
+	assert [int(line[3]) for line in lines] == sorted(set(int(line[3]) for line in lines))
+	with open(prefix + ".fam") as file:
+		assert [line.split()[1] for line in file] == plink_io.sample_names(7)
+
+
+def test_bed_subset_keeps_flagged_records(tmp_path):
+	ts = simulate()
+	prefix = str(tmp_path / "model_1")
+	n_snps = plink_io.write_plink(ts, prefix, 1)
+	keep = [k % 3 == 0 for k in range(n_snps)]
+	plink_io.write_bed_subset(prefix, prefix + "_sub", keep, block_size = 4)
+
+	full = np.concatenate(list(plink_io.read_bed(prefix)))
+	sub = np.concatenate(list(plink_io.read_bed(prefix + "_sub")))
+	assert np.array_equal(sub, full[np.array(keep)])
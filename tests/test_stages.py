@@ -0,0 +1,37 @@
+import os
+
+import model_admix
+
+stub_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "stubs")
+
+params = {'pop1': 10000, 'pop2': 10000, 'pop3': 5000, 'time_admix': 6000, 'prop_pop1': 0.3, 'prop_pop2': 0.7,
+'chrom': 21, 'dem_option': 'constant', 'sample_pop1': 5, 'sample_pop2': 5, 'sample_pop3': 5, 'length': 200000, 'seed': 1,
+'pca_engine': 'numpy', 'prune_engine': 'numpy', 'admixture_engine': 'numpy'}
+
+
+def stage_lines(capsys, status):
+	return [line.split()[1] for line in capsys.readouterr().out.splitlines() if line.startswith(status)]
+
+
+#Changing a stage's options reruns that stage and the stages reading its outputs, and nothing else
+def test_changed_options_rerun_their_stages(tmp_path, monkeypatch, capsys):
+	monkeypatch.setenv("PATH", stub_dir + os.pathsep + os.environ["PATH"])
+	outdir = str(tmp_path / "run")
+	model_admix.run_pipeline(params, outdir)
+	capsys.readouterr()
+
+	model_admix.run_pipeline(params, outdir)
+	assert stage_lines(capsys, "RUNNING") == []
+
+	model_admix.run_pipeline(dict(params, vcf_level = 9, prune_engine = 'plink'), outdir)
+	assert set(stage_lines(capsys, "RUNNING")) == {'VCF', 'PRUNE', 'MAKE_BEDS', 'PRUNE_MP', 'ADMIXTURE'}
+
+
+def test_changed_options_rerun_their_stages_with_hashes(tmp_path, monkeypatch, capsys):
+	monkeypatch.setenv("PATH", stub_dir + os.pathsep + os.environ["PATH"])
+	outdir = str(tmp_path / "run")
+	model_admix.run_pipeline(dict(params, check = 'hash'), outdir)
+	capsys.readouterr()
+
+	model_admix.run_pipeline(dict(params, check = 'hash', pca_engine = 'plink'), outdir)
+	assert stage_lines(capsys, "RUNNING") == ['PCA']
@@ -0,0 +1,44 @@
+import model_admix
+import sweep
+
+params = {'pop1': 10000, 'pop2': 10000, 'pop3': 5000, 'time_admix': 6000, 'prop_pop1': 0.3, 'prop_pop2': 0.7,
+'chrom': [21, 22], 'dem_option': 'constant', 'sample_pop1': 5, 'sample_pop2': 5, 'sample_pop3': 5}
+
+
+def parsed(params):
+	return vars(model_admix.build_parser().parse_args(sweep.command_line(params)[2:]))
+
+
+#List values reach model_admix.py as it would read them from a hand-written command line
+def test_list_values_round_trip():
+	options = parsed(dict(params, only = ['pca', 'prune'], subsample = [[2, 2, 2], [3, 3, 3]], 
+		mutation_rates = [1e-8, 2e-8], run_from = 'pca', plink_convert = True, seed = None))
+	assert options['chrom'] == '21,22'
+	assert options['only'] == 'pca,prune'
+	assert options['subsample'] == [[2, 2, 2], [3, 3, 3]]
+	assert [float(rate) for rate in options['mutation_rates'].split(',')] == [1e-8, 2e-8]
+	assert options['run_from'] == 'pca'
+	assert options['plink_convert'] and options['seed'] is None
+
+
+def test_single_subsample():
+	assert parsed(dict(params, subsample = [2, 2, 2]))['subsample'] == [[2, 2, 2]]
+
+
+def test_expand_chroms_reads_chromosomes_as_model_admix_does():
+	for spec in ('1-3', [4, 5], '7', 'all'):
+		assert sweep.expand_chroms(spec) == model_admix.parse_chroms(sweep.as_spec(spec))
+
+
+#Both drivers read "replicates" as separate runs with their own seeds, also without a seed,
+#and the seeds come out the same every time the sweep is read
+def test_replicates_are_separate_seeded_runs():
+	import scheduler
+	for base in (params, dict(params, seed = 3)):
+		runs = sweep.expand_sweep({'base': dict(base, replicates = 3)})
+		assert [run['replicate'] for run in runs] == [1, 2, 3]
+		assert len(set(run['seed'] for run in runs)) == 3
+		assert runs == sweep.expand_sweep({'base': dict(base, replicates = 3)})
+		assert all('--replicates' not in sweep.command_line(run) for run in runs)
+		tasks = scheduler.expand_tasks(runs)
+		assert len(tasks) == 6 and set(task['seed'] for task in tasks) == set(run['seed'] for run in runs)